@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Compares finding the handler for a URL with and without the host index.
+
+Generates a few thousand URLs for the supported sites (plus some which
+nothing handles), and looks each one up both ways: by asking every site in
+turn, as sites.get used to, and with sites.get. Nothing is fetched. Run from
+the project directory:
+
+    $ python3 benchmarks/dispatch.py --count 5000
+"""
+
+import os
+import random
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sites  # noqa: E402
+
+TEMPLATES = (
+    'https://archiveofourown.org/works/{n}/chapters/{m}',
+    'https://archiveofourown.org/series/{n}',
+    'https://www.fanfiction.net/s/{n}/{m}/Some-Story',
+    'https://m.fictionpress.com/s/{n}/1/',
+    'https://www.royalroad.com/fiction/{n}/some-story',
+    'https://royalroadl.com/fiction/{n}/some-story/chapter/{m}/one',
+    'https://www.wattpad.com/story/{n}-some-story',
+    'https://fiction.live/stories/Some-Story/{n}abcDEF',
+    'https://sta.sh/2{n}',
+    'https://someone.deviantart.com/gallery/{n}/',
+    'https://forums.spacebattles.com/threads/some-story.{n}/',
+    'https://forums.spacebattles.com/posts/{n}/',
+    'https://forums.sufficientvelocity.com/threads/some-story.{n}/reader',
+    'https://forum.questionablequesting.com/threads/some-story.{n}/page-{m}',
+    'https://www.alternatehistory.com/forum/threads/some-story.{n}/',
+    'https://example.com/{n}/not-a-story',
+    'https://practicalguidetoevil.wordpress.com/{n}/{m}/',
+)
+
+
+def linear(url):
+    for site_class in sites._sites:
+        match = site_class.matches(url)
+        if match:
+            return site_class, match
+    raise NotImplementedError("Could not find a handler for " + url)
+
+
+def lookup(get, urls):
+    results = []
+    start = time.perf_counter()
+    for url in urls:
+        try:
+            results.append(get(url))
+        except NotImplementedError:
+            results.append(None)
+    return time.perf_counter() - start, results
+
+
+@click.command()
+@click.option('--count', default=5000, help="How many URLs to look up")
+@click.option('--seed', default=0, help="Random seed for the generated URLs")
+def run(count, seed):
+    """Benchmark sites.get over COUNT generated URLs"""
+    # the linear lookup needs every site, not just those the manifest picks out
+    sites._import_all()
+    rng = random.Random(seed)
+    urls = [
+        rng.choice(TEMPLATES).format(n=rng.randint(1, 10 ** 7), m=rng.randint(1, 500))
+        for _ in range(count)
+    ]
+    # warm up the pattern caches, so it's just lookups being timed
+    lookup(linear, urls[:100])
+    lookup(sites.get, urls[:100])
+
+    linear_time, linear_results = lookup(linear, urls)
+    indexed_time, indexed_results = lookup(sites.get, urls)
+    if linear_results != indexed_results:
+        raise click.ClickException("The host index found different handlers for some URLs")
+
+    click.echo(f"{len(sites._sites)} sites, {count} URLs")
+    click.echo(f"every site: {linear_time:.3f}s ({1e6 * linear_time / count:.1f}µs/URL)")
+    click.echo(f"host index: {indexed_time:.3f}s ({1e6 * indexed_time / count:.1f}µs/URL)")
+    click.echo(f"speedup:    {linear_time / indexed_time:.1f}x")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,376 @@
+"""Made-up pages for every site, shaped like the real ones as far as leech's
+site handlers look at them.
+
+Each builder takes how many chapters to make, how many paragraphs each gets,
+and how often a chapter has an image in it (every Nth, 0 for never), and
+returns a Fixture: the URL to hand leech, and every page it'll fetch for it,
+by URL. The text is generated from a fixed seed, so every run gets the same
+pages. See offline.py.
+"""
+
+import base64
+import functools
+import io
+import json
+import random
+
+import attr
+import requests
+
+TITLE = 'Bench Story'
+AUTHOR = 'Bench Author'
+SUMMARY = 'A story which only exists to be downloaded over and over again.'
+# 2020-09-13; chapters come out a day apart from here
+EPOCH = 1600000000
+
+WORDS = (
+    'the', 'of', 'and', 'a', 'to', 'in', 'was', 'he', 'she', 'it', 'that', 'her', 'his', 'had', 'with', 'for', 'as',
+    'at', 'on', 'they', 'but', 'not', 'be', 'from', 'were', 'said', 'one', 'all', 'there', 'would', 'what', 'out',
+    'door', 'light', 'long', 'night', 'looked', 'hand', 'room', 'never', 'again', 'before', 'something', 'quietly',
+    'sword', 'letter', 'library', 'river', 'stranger', 'morning', 'remembered', 'carefully', 'impossible', 'window',
+)
+
+
+@attr.s
+class Fixture:
+    url = attr.ib()
+    # URL -> (content type, body)
+    pages = attr.ib()
+    # for Arbitrary: the definition to write out, whose filename is then the URL
+    definition = attr.ib(default=None)
+
+
+def _html(body, head=''):
+    page = f'<!DOCTYPE html><html><head><meta charset="utf-8"/><title>{TITLE}</title>{head}</head><body>{body}</body></html>'
+    return 'text/html; charset=utf-8', page.encode('utf-8')
+
+
+def _json(data):
+    return 'application/json; charset=utf-8', json.dumps(data).encode('utf-8')
+
+
+def _pages(pages):
+    # keyed the way requests will ask for them
+    return {requests.Request('GET', url).prepare().url: page for url, page in pages.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def image(image_format='PNG', size=(1200, 900)):
+    """A smooth, photo-ish image; big enough to need shrinking"""
+    from PIL import Image
+    gradient = Image.linear_gradient('L')
+    picture = Image.merge('RGB', (gradient, Image.radial_gradient('L'), gradient.rotate(90)))
+    out = io.BytesIO()
+    picture.resize(size).save(out, format=image_format)
+    return out.getvalue()
+
+
+def data_uri():
+    return 'data:image/png;base64,' + base64.b64encode(image()).decode('ascii')
+
+
+def _text(seed, paragraphs, image_src=None, spoiler=None):
+    """Chapter text, with the sort of inline markup the sites' cleaning has to deal with"""
+    rng = random.Random(seed)
+    out = []
+    for n in range(paragraphs):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(40, 120))]
+        words[0] = words[0].capitalize()
+        i = rng.randrange(len(words))
+        words[i] = f'<em>{words[i]}</em>'
+        if n % 7 == 3:
+            i = rng.randrange(len(words))
+            words[i] = f'<span style="color: #c00000">{words[i]}</span>'
+        if n % 11 == 5:
+            i = rng.randrange(len(words))
+            words[i] = f'<strong>{words[i]}</strong>'
+        out.append('<p>' + ' '.join(words) + '.</p>')
+    if image_src:
+        out.insert(paragraphs // 2, f'<p><img src="{image_src}" alt="An illustration"/></p>')
+    if spoiler:
+        out.insert(paragraphs // 3, spoiler)
+    return '\n'.join(out)
+
+
+def _has_image(n, images):
+    return images and (n - 1) % images == 0
+
+
+def _date(n):
+    return EPOCH + n * 86400
+
+
+def ao3(chapters, paragraphs, images):
+    work = 1000001
+    text = ''.join(
+        f'<div class="chapter" id="chapter-{n}"><div class="chapter preface group"><h3 class="title">Chapter {n}</h3></div>'
+        f'<div class="userstuff module" role="article"><h3 class="landmark heading" id="work">Chapter Text</h3>'
+        f'{_text(n, paragraphs, _has_image(n, images) and data_uri())}</div></div>'
+        for n in range(1, chapters + 1)
+    )
+    full = _html(
+        '<div id="main"><div class="wrapper"><dl class="work meta group">'
+        '<dd class="freeform tags"><ul class="commas">'
+        '<li><a class="tag" href="/tags/Fluff">Fluff</a></li><li><a class="tag" href="/tags/Angst">Angst</a></li>'
+        '</ul></dd></dl></div>'
+        f'<div id="workskin"><div class="preface group"><h2 class="title heading">{TITLE}</h2>'
+        f'<h3 class="byline heading"><a rel="author" href="/users/bench">{AUTHOR}</a></h3>'
+        f'<div class="summary module"><h3 class="heading">Summary:</h3><blockquote class="userstuff"><p>{SUMMARY}</p></blockquote></div>'
+        f'</div><div id="chapters">{text}</div></div></div>'
+    )
+    navigate = _html(
+        '<div id="main"><ol class="chapter index group" role="navigation">' + ''.join(
+            f'<li><a href="/works/{work}/chapters/{2000000 + n}">{n}. Chapter {n}</a> '
+            f'<span class="datetime">(2020-10-{n % 28 + 1:02})</span></li>'
+            for n in range(1, chapters + 1)
+        ) + '</ol></div>'
+    )
+    return Fixture(f'https://archiveofourown.org/works/{work}', _pages({
+        f'http://archiveofourown.org/works/{work}?view_adult=true&view_full_work=true': full,
+        f'https://archiveofourown.org/works/{work}/navigate': navigate,
+    }))
+
+
+def royalroad(chapters, paragraphs, images):
+    story = 'https://www.royalroad.com/fiction/1000001/bench-story'
+    index = _html(
+        '<div class="fic-header"><img class="thumbnail" src="/covers/1000001.png"/>'
+        f'<h1 property="name">{TITLE}</h1></div>'
+        f'<div class="description"><div property="description"><p>{SUMMARY}</p></div></div>'
+        '<span class="tags"><a class="fiction-tag" href="/tags/fantasy">Fantasy</a><a class="fiction-tag" href="/tags/litrpg">LitRPG</a></span>'
+        '<table id="chapters"><tbody>' + ''.join(
+            f'<tr data-url="/fiction/1000001/bench-story/chapter/{3000000 + n}/chapter-{n}">'
+            f'<td><a href="/fiction/1000001/bench-story/chapter/{3000000 + n}/chapter-{n}">Chapter {n}</a></td></tr>'
+            for n in range(1, chapters + 1)
+        ) + '</tbody></table>',
+        head=(
+            '<base href="https://www.royalroad.com/"/>'
+            f'<meta property="books:author" content="{AUTHOR}"/><meta property="og:url" content="{story}"/>'
+        )
+    )
+    pages = {
+        'https://www.royalroad.com/fiction/1000001': index,
+        'https://www.royalroad.com/covers/1000001.png': ('image/png', image()),
+    }
+    for n in range(1, chapters + 1):
+        spoiler = n % 4 == 2 and (
+            f'<div class="spoiler-new" data-caption="Spoiler {n}">{_text(-n, 1)}</div>'
+        )
+        note = f'<div class="author-note-portlet"><div class="author-note">{_text(-n, 1)}</div></div>'
+        pages[f'{story}/chapter/{3000000 + n}/chapter-{n}'] = _html(
+            f'<div class="profile-info"><time unixtime="{_date(n)}">a while ago</time></div>'
+            f'{note if n % 2 else ""}'
+            f'<div class="chapter-inner chapter-content">{_text(n, paragraphs, _has_image(n, images) and data_uri(), spoiler)}</div>'
+            f'{note if n % 3 == 0 else ""}'
+        )
+    return Fixture('https://www.royalroad.com/fiction/1000001/bench-story', _pages(pages))
+
+
+def fanfictionnet(chapters, paragraphs, images):
+    story = 'https://www.fanfiction.net/s/1000001/'
+    options = ''.join(f'<option  value={n} >{n}. Chapter {n}' for n in range(1, chapters + 1))
+    chapter_select = (
+        f"<select id=chap_select title='Chapter Navigation' "
+        f"onChange=\"self.location='/s/1000001/'+ this.options[this.selectedIndex].value + '/bench-story';\">{options}</select>"
+    )
+    pages = {}
+    for n in range(1, chapters + 1):
+        page = _html(
+            '<div id="content_wrapper_inner"><div id="profile_top">'
+            f'<b class="xcontrast_txt">{TITLE}</b> By: <a class="xcontrast_txt" href="/u/1/">{AUTHOR}</a>'
+            f'<span class="xgray">Updated: <span data-xutime="{_date(chapters)}">Oct 1</span> - '
+            f'Published: <span data-xutime="{_date(1)}">Sep 14</span></span></div>'
+            f'{chapter_select}'
+            f'<div class="storytext xcontrast_txt nocopy" id="storytext">{_text(n, paragraphs, _has_image(n, images) and data_uri())}</div>'
+            '</div>'
+        )
+        pages[f'{story}{n}/bench-story'] = page
+        if n == 1:
+            pages[story] = page
+    return Fixture(story, _pages(pages))
+
+
+def _xenforo_pages(chapters, per_page, post):
+    """Reader pages, each linking to the next"""
+    pages = []
+    for start in range(1, chapters + 1, per_page):
+        pages.append(''.join(post(n) for n in range(start, min(start + per_page, chapters + 1))))
+    return pages
+
+
+def xenforo(chapters, paragraphs, images):
+    thread = 'https://forum.questionablequesting.com/threads/bench-story.1000001/'
+
+    def post(n):
+        spoiler = n % 4 == 2 and (
+            f'<div class="ToggleTriggerAnchor bbCodeSpoilerContainer"><button class="SpoilerTitle">Spoiler {n}</button>'
+            f'<div class="SpoilerTarget bbCodeSpoilerText">{_text(-n, 1)}</div></div>'
+        )
+        return (
+            f'<li id="post-{4000000 + n}" class="message hasThreadmark">'
+            f'<div class="threadmarker"><span class="label"><strong>Threadmark:</strong> Chapter {n}</span></div>'
+            f'<div class="messageContent"><article><blockquote class="messageText SelectQuoteContainer ugc baseHtml">'
+            f'{_text(n, paragraphs, _has_image(n, images) and data_uri(), spoiler)}</blockquote></article></div>'
+            f'<span class="DateTime" data-time="{_date(n)}">Sep 14, 2020</span></li>'
+        )
+
+    head = '<base href="https://forum.questionablequesting.com/"/>' f'<meta property="og:url" content="{thread}"/>'
+    pages = {
+        thread: _html(
+            f'<div class="titleBar"><h1><span class="prefix">Story</span> {TITLE}</h1>'
+            f'<p id="pageDescription">Discussion in <a href="forums/x/">Creative Writing</a> started by <a class="username" href="members/1/">{AUTHOR}</a></p></div>'
+            '<a class="readerToggle" href="threads/bench-story.1000001/reader">Reader mode</a>',
+            head=head
+        )
+    }
+    reader = _xenforo_pages(chapters, 10, post)
+    for page, posts in enumerate(reader, 1):
+        url = f'{thread}reader' + (f'?page={page}' if page > 1 else '')
+        next_page = page < len(reader) and f'<link rel="next" href="threads/bench-story.1000001/reader?page={page + 1}"/>' or ''
+        pages[url] = _html(f'<ol id="messageList" class="messageList">{posts}</ol>', head=head + next_page)
+    return Fixture(thread, _pages(pages))
+
+
+def xenforo2(chapters, paragraphs, images):
+    thread = 'https://forums.spacebattles.com/threads/bench-story.1000001/'
+
+    def post(n):
+        spoiler = n % 4 == 2 and (
+            f'<div class="bbCodeSpoiler"><button class="bbCodeSpoiler-button"><span class="bbCodeSpoiler-button-title">Spoiler {n}</span></button>'
+            f'<div class="bbCodeSpoiler-content"><div class="bbCodeBlock bbCodeBlock--spoiler"><div class="bbCodeBlock-content">{_text(-n, 1)}</div></div></div></div>'
+        )
+        return (
+            f'<article class="message message--post hasThreadmark" id="js-post-{4000000 + n}">'
+            f'<div class="message-cell"><span class="threadmarkLabel">Chapter {n}</span>'
+            f'<header class="message-attribution"><time class="u-dt" data-time="{_date(n)}">Sep 14, 2020</time></header>'
+            f'<div class="message-userContent lbContainer js-lbContainer"><article class="message-body"><div class="bbWrapper">'
+            f'{_text(n, paragraphs, _has_image(n, images) and data_uri(), spoiler)}</div></article></div></div></article>'
+        )
+
+    head = '<base href="https://forums.spacebattles.com/"/>' f'<meta property="og:url" content="{thread}"/>'
+    pages = {
+        thread: _html(
+            f'<div class="p-title"><h1 class="p-title-value"><span class="label">Story</span> {TITLE}</h1></div>'
+            f'<div class="p-description"><a class="username" href="members/1/">{AUTHOR}</a></div>'
+            '<div class="threadmarks-reader"><a href="threads/bench-story.1000001/reader/">Reader mode</a></div>',
+            head=head
+        )
+    }
+    reader = _xenforo_pages(chapters, 10, post)
+    for page, posts in enumerate(reader, 1):
+        url = f'{thread}reader/' + (f'page-{page}' if page > 1 else '')
+        next_page = page < len(reader) and f'<link rel="next" href="threads/bench-story.1000001/reader/page-{page + 1}"/>' or ''
+        pages[url] = _html(f'<div class="block-body js-replyNewMessageContainer">{posts}</div>', head=head + next_page)
+    return Fixture(thread, _pages(pages))
+
+
+def fictionlive(chapters, paragraphs, images):
+    story = 'benchstory01'
+    created = [_date(n) * 1000 for n in range(1, chapters + 1)]
+    pages = {
+        f'https://fiction.live/api/node/{story}': _json({
+            't': TITLE,
+            'u': [{'n': AUTHOR}],
+            'bm': [{'id': f'chapter{n}', 'title': f'Chapter {n}', 'ct': ct} for n, ct in enumerate(created, 1)],
+        }),
+    }
+    for n, ct in enumerate(created, 1):
+        end = created[n] - 1 if n < chapters else 9999999999999998
+        segments = [{'nt': 'chapter', 'b': _text(n, paragraphs, _has_image(n, images) and data_uri()), 'ct': ct + 1000}]
+        if n % 3 == 0:
+            segments.append({
+                'nt': 'choice', 'b': 'What next?', 'ct': ct + 2000, 'closed': True,
+                'choices': ['Go left', 'Go right', 'Stay'],
+                'votes': {f'voter{v}': v % 3 for v in range(40)},
+            })
+        pages[f'https://fiction.live/api/anonkun/chapters/{story}/{ct}/{end}'] = _json(segments)
+    return Fixture(f'https://fiction.live/stories/Bench-Story/{story}', _pages(pages))
+
+
+def wattpad(chapters, paragraphs, images):
+    parts = [5000000 + n for n in range(1, chapters + 1)]
+    pages = {
+        'https://www.wattpad.com/api/v3/stories/1000001': _json({
+            'title': TITLE,
+            'user': {'name': AUTHOR},
+            'cover': 'https://img.wattpad.com/cover/1000001-256.jpg',
+            'parts': [
+                {'id': part, 'title': f'Chapter {n}', 'createDate': f'2020-10-{n % 28 + 1:02}T12:00:00Z'}
+                for n, part in enumerate(parts, 1)
+            ],
+        }),
+        'https://img.wattpad.com/cover/1000001-256.jpg': ('image/jpeg', image('JPEG')),
+    }
+    for n, part in enumerate(parts, 1):
+        pages[f'https://www.wattpad.com/apiv2/storytext?id={part}'] = (
+            'text/html; charset=utf-8', _text(n, paragraphs, _has_image(n, images) and data_uri()).encode('utf-8')
+        )
+    return Fixture('https://www.wattpad.com/story/1000001-bench-story', _pages(pages))
+
+
+def stash(chapters, paragraphs, images):
+    folder = 'https://sta.sh/21000001/'
+    pages = {
+        folder: _html(
+            f'<span class="oh-stashlogo-name">{AUTHOR}\'s</span>'
+            f'<div class="stash-folder-name"><h2>{TITLE}</h2></div>'
+            '<div id="stash-body"><div class="stash-folder-stream">' + ''.join(
+                f'<a class="thumb" href="https://sta.sh/0bench{n:04}">Chapter {n}</a>' for n in range(1, chapters + 1)
+            ) + '<a class="thumb" href="#">Upload</a></div></div>'
+        ),
+    }
+    for n in range(1, chapters + 1):
+        pages[f'https://sta.sh/0bench{n:04}'] = _html(
+            '<div class="journal-wrapper"><div class="gr-top"><div class="metadata">'
+            f'<h2><a href="https://sta.sh/0bench{n:04}">Chapter {n}</a></h2></div></div>'
+            f'<div class="text" style="font-size: 12px">{_text(n, paragraphs, _has_image(n, images) and data_uri())}</div></div>'
+            f'<div class="dev-metainfo-details"><span ts="{_date(n)}">Sep 14, 2020</span></div>'
+        )
+    return Fixture(folder.rstrip('/'), _pages(pages))
+
+
+def arbitrary(chapters, paragraphs, images):
+    # like examples/pale.json, images and all
+    site = 'https://fixtures.example/bench-story/'
+    pages = {
+        site: _html(
+            '<div id="main"><article><div class="entry-content">' + ''.join(
+                f'<p><a href="{site}chapter-{n}/">Chapter {n}</a></p>' for n in range(1, chapters + 1)
+            ) + '</div></article></div>'
+        ),
+    }
+    for n in range(1, chapters + 1):
+        image_src = _has_image(n, images) and f'{site}images/chapter-{n}.jpg'
+        if image_src:
+            pages[image_src] = ('image/jpeg', image('JPEG'))
+        pages[f'{site}chapter-{n}/'] = _html(
+            f'<div id="main"><article><h1 class="entry-title">Chapter {n}</h1><div class="entry-content">'
+            f'{_text(n, paragraphs, image_src)}'
+            '<div class="sharedaddy"><a href="https://fixtures.example/share">Share this</a></div>'
+            '<style>.entry-content { color: red }</style>'
+            '</div></article></div>'
+        )
+    return Fixture(None, _pages(pages), definition={
+        'url': site,
+        'title': TITLE,
+        'author': AUTHOR,
+        'content_selector': '#main',
+        'content_title_selector': 'h1.entry-title',
+        'content_text_selector': '.entry-content',
+        'chapter_selector': 'article .entry-content > p a',
+        'filter_selector': '.sharedaddy, style',
+        'image_selector': '.entry-content img',
+    })
+
+
+SITES = {
+    'ao3': ao3,
+    'royalroad': royalroad,
+    'fanfictionnet': fanfictionnet,
+    'xenforo': xenforo,
+    'xenforo2': xenforo2,
+    'fictionlive': fictionlive,
+    'wattpad': wattpad,
+    'stash': stash,
+    'arbitrary': arbitrary,
+}
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Times converting chapter images the way ebook does before they go in the epub.
+
+By default the images are made up, shaped like the ones chapters tend to
+have: phone photos, screenshots, character art with transparency, small
+dividers and already-small JPEGs. Point --corpus at a directory of real
+ones to use those instead. For each image, how long ebook.image.convert_image
+takes (the best of --repeat runs), and what it made of it. Run from the
+project directory:
+
+    $ python3 benchmarks/images.py --corpus ~/chapter-images
+"""
+
+import io
+import os
+import sys
+import time
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def _picture(size, mode='RGB', seed=0):
+    """Smooth gradients with some grain in them, so that it compresses more like a photo than a gradient would"""
+    from PIL import Image
+    gradient = Image.linear_gradient('L').resize(size)
+    grain = Image.effect_noise(size, 40 + seed)
+    bands = (Image.blend(gradient, grain, 0.3), Image.radial_gradient('L').resize(size), Image.blend(gradient.rotate(90 + seed), grain, 0.1))
+    picture = Image.merge('RGB', bands)
+    if mode == 'RGBA':
+        picture.putalpha(Image.radial_gradient('L').resize(size).point(lambda value: 255 - value))
+    elif mode != 'RGB':
+        picture = picture.convert(mode)
+    return picture
+
+
+def _encoded(picture, image_format, **params):
+    out = io.BytesIO()
+    picture.save(out, format=image_format, **params)
+    return out.getvalue()
+
+
+def corpus():
+    """(name, bytes) for a made-up spread of chapter images"""
+    from PIL import Image
+    return [
+        ('phone photo', _encoded(_picture((4032, 3024)), 'JPEG', quality=92)),
+        ('wallpaper', _encoded(_picture((1920, 1080), seed=1), 'JPEG', quality=90)),
+        ('web jpeg', _encoded(_picture((800, 600), seed=2), 'JPEG', quality=85)),
+        ('small jpeg', _encoded(_picture((400, 300), seed=3), 'JPEG', quality=85)),
+        ('screenshot', _encoded(_picture((1280, 2400), seed=4), 'PNG')),
+        ('character art', _encoded(_picture((1600, 2000), 'RGBA', seed=5), 'PNG')),
+        ('divider', _encoded(_picture((600, 40), seed=6).convert('P', palette=Image.ADAPTIVE, colors=16), 'PNG')),
+        ('webp', _encoded(_picture((1500, 1000), seed=7), 'WEBP')),
+    ]
+
+
+def load_corpus(directory):
+    return [
+        (name, open(os.path.join(directory, name), 'rb').read())
+        for name in sorted(os.listdir(directory))
+        if os.path.isfile(os.path.join(directory, name))
+    ]
+
+
+def _dimensions(data):
+    from PIL import Image
+    try:
+        image = Image.open(io.BytesIO(data))
+        return f'{image.format} {image.size[0]}x{image.size[1]}'
+    except Exception:
+        return '?'
+
+
+def _kb(b):
+    return f'{b / 1024:.0f}KB'
+
+
+@click.command()
+@click.option('--corpus', 'directory', type=click.Path(exists=True, file_okay=False), help="A directory of images to use instead of made-up ones")
+@click.option('--repeat', default=3, help="How many times to convert each image; the quickest counts")
+def run(directory, repeat):
+    """Benchmark compressing chapter images"""
+    from ebook.image import convert_image
+
+    images = load_corpus(directory) if directory else corpus()
+    click.echo(f"{'image':<24}{'before':>22}{'size':>9}{'after':>22}{'size':>9}{'seconds':>9}")
+    total = 0
+    for name, data in images:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            converted, _, _ = convert_image(data)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        total += best
+        click.echo(
+            f"{name[:23]:<24}{_dimensions(data):>22}{_kb(len(data)):>9}"
+            f"{_dimensions(converted):>22}{_kb(len(converted)):>9}{best:>9.3f}"
+        )
+    click.echo(f"{'total':<86}{total:>9.3f}")
+
+
+if __name__ == '__main__':
+    run()
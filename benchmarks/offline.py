@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Times downloading a story from every site, without going anywhere near the network.
+
+Each site's pages come from fixtures.py, served by a stand-in transport
+mounted on the session the site is given. Every site runs in a fresh
+interpreter, so that its peak memory is its own. The story is downloaded as
+`leech download` does it (leech.download_story, which renders and writes
+chapters into the epub while the rest are still being fetched, with an empty
+image cache), and then again in two steps, extracting the story and then
+generating its epub, for comparison. For each, it shows how long it took and
+where that time went by stage (as in --metrics); the peak RSS is from before
+the second go. Run from the project directory:
+
+    $ python3 benchmarks/offline.py --chapters 50 --site royalroad --site ao3
+
+It exits with an error if any site fails, or takes longer or more memory
+than --max-seconds or --max-rss allow, so CI can run it as a smoke test.
+
+The epub is given the same session, so covers and images come from the
+fixtures too.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fixtures  # noqa: E402
+import sites  # noqa: E402
+
+COLUMNS = ('download', 'extract', 'epub')
+
+
+class FixtureAdapter(requests.adapters.BaseAdapter):
+    """Answers requests from a fixture's pages, and 404s anything else"""
+
+    def __init__(self, pages):
+        super().__init__()
+        self.pages = pages
+
+    def send(self, request, **kwargs):
+        response = requests.models.Response()
+        content_type, body = self.pages.get(request.url, ('text/html; charset=utf-8', b'<html><body>Not found</body></html>'))
+        response.status_code = 200 if request.url in self.pages else 404
+        response.reason = 'OK' if response.ok else 'Not Found'
+        response.headers = requests.structures.CaseInsensitiveDict({'Content-Type': content_type, 'Content-Length': str(len(body))})
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = body
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def _peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(name, chapters, paragraphs, images, spill_over=None, parser=None):
+    """Download one site's fixture story, in this process: as `leech download` would, and then in two steps"""
+    import leech
+    import ebook
+    import sites
+    from sites.metrics import metrics
+    from sites.store import ImageCache
+
+    if spill_over:
+        sites.spill.configure(spill_over * 1024)
+    fixture = fixtures.SITES[name](chapters, paragraphs, images)
+    session = leech.create_session(False)
+    adapter = FixtureAdapter(fixture.pages)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = fixture.url
+        if fixture.definition:
+            url = os.path.join(directory, 'definition.json')
+            with open(url, 'w') as definition_file:
+                json.dump(fixture.definition, definition_file)
+
+        site, site_url = sites.get(url)
+        # as if none of the site's flags were given, besides --parser
+        flags = {option.name: None for option in site.get_site_specific_option_defs()}
+        flags['parser'] = parser
+        result = {'site': site.__name__, 'rss_before': _peak_rss()}
+
+        start = time.perf_counter()
+        filename = leech.download_story(
+            url, session, '{}', False, directory, flags,
+            image_cache=ImageCache(os.path.join(directory, 'images.db')), gif_limits=ebook.GifLimits()
+        )
+        result['download'] = time.perf_counter() - start
+        result['download_rss'] = _peak_rss()
+        result['download_metrics'] = metrics.drain()
+        result['epub_size'] = os.path.getsize(os.path.join(directory, filename))
+
+        options, _ = leech.create_options(site, '{}', flags)
+        handler = site(session, options=options)
+        start = time.perf_counter()
+        story = handler.extract(site_url)
+        result['extract'] = time.perf_counter() - start
+        result['extract_metrics'] = metrics.drain()
+        result['chapters'] = len(story)
+
+        start = time.perf_counter()
+        os.mkdir(os.path.join(directory, 'two-step'))
+        ebook.generate_epub(story, {}, output_dir=os.path.join(directory, 'two-step'), session=session)
+        result['epub'] = time.perf_counter() - start
+        result['epub_metrics'] = metrics.drain()
+    return result
+
+
+def _mb(b):
+    return f'{b / 1024 / 1024:.1f}MB'
+
+
+def _stages(drained):
+    stages = sorted(drained['stages'].items(), key=lambda item: -item[1][1])
+    return ', '.join(f'{name} {seconds:.2f}s' for name, (count, seconds) in stages) or '-'
+
+
+@click.command()
+@click.option('--site', 'names', multiple=True, type=click.Choice(list(fixtures.SITES)), help="Which sites (default: all of them)")
+@click.option('--chapters', default=20, help="How many chapters each story has")
+@click.option('--paragraphs', default=30, help="How many paragraphs each chapter has")
+@click.option('--images', default=5, help="Put an image in every Nth chapter (0 for none)")
+@click.option('--spill-over', type=int, help="As with leech download --spill-over")
+@click.option('--parser', type=click.Choice(sites.PARSERS), help="Parse pages with this, rather than the default")
+@click.option('--max-seconds', type=float, help="Fail if any site takes longer than this to extract and make an epub")
+@click.option('--max-rss', type=float, help="Fail if any site's peak RSS goes over this many MB")
+@click.option('--one', hidden=True, help="Measure just this site, in this process, and print the results as JSON")
+def run(names, chapters, paragraphs, images, spill_over, parser, max_seconds, max_rss, one):
+    """Benchmark downloading stories from made-up pages for every site"""
+    if one:
+        result = measure(one, chapters, paragraphs, images, spill_over, parser)
+        # everything before this is whatever downloading printed
+        click.echo('\n' + json.dumps(result))
+        return
+    click.echo(f"{'':<25}{'seconds':^29}{'peak RSS after':^20}")
+    click.echo(f"{'site':<16}{'chapters':>9}{'download':>11}{'extract':>9}{'epub':>9}{'imports':>10}{'download':>10}{'epub size':>11}")
+    problems = []
+    for name in names or fixtures.SITES:
+        command = [sys.executable, __file__, '--one', name, '--chapters', str(chapters), '--paragraphs', str(paragraphs), '--images', str(images)]
+        if spill_over:
+            command += ['--spill-over', str(spill_over)]
+        if parser:
+            command += ['--parser', parser]
+        output = subprocess.run(
+            command,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+        )
+        if output.returncode:
+            click.echo(f"{name:<16}failed:\n{output.stderr}")
+            problems.append(f"{name} failed")
+            continue
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        click.echo(
+            f"{name:<16}{result['chapters']:>9}{result['download']:>10.2f}s{result['extract']:>8.2f}s{result['epub']:>8.2f}s"
+            f"{_mb(result['rss_before']):>10}{_mb(result['download_rss']):>10}{_mb(result['epub_size']):>11}"
+        )
+        for column in COLUMNS:
+            drained = result[f'{column}_metrics']
+            click.echo(f"  {column:<9}{len(drained['requests']):>4} requests; {_stages(drained)}")
+        if max_seconds and result['download'] > max_seconds:
+            problems.append(f"{name} took {result['download']:.2f}s")
+        if max_rss and result['download_rss'] > max_rss * 1024 * 1024:
+            problems.append(f"{name} peaked at {_mb(result['download_rss'])}")
+    if problems:
+        raise click.ClickException('; '.join(problems))
+
+
+if __name__ == '__main__':
+    run()
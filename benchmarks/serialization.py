@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Compares prettify() with compact serialization of chapter HTML.
+
+Runs the example stories through the arbitrary-site handler, and serializes
+every chapter both ways: how long that takes, and how big the HTML is before
+and after the deflating it gets in the epub.
+
+Pages come from the usual leech cache, so only the first run needs to fetch
+them. Run from the project directory:
+
+    $ python3 benchmarks/serialization.py examples/pale.json examples/twig.json
+"""
+
+import glob
+import os
+import sys
+import time
+import zlib
+
+import attr
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import leech  # noqa: E402
+from sites.arbitrary import Arbitrary  # noqa: E402
+
+
+@attr.s
+class MeasuredArbitrary(Arbitrary):
+    """Serializes each chapter both ways, keeping totals, and carries on with the compact one"""
+    totals = attr.ib(init=False, factory=lambda: dict.fromkeys((
+        'chapters', 'pretty_time', 'compact_time', 'pretty_size', 'compact_size', 'pretty_zipped', 'compact_zipped'
+    ), 0))
+
+    def _serialize(self, tag):
+        start = time.perf_counter()
+        pretty = tag.prettify()
+        middle = time.perf_counter()
+        compact = str(tag)
+        end = time.perf_counter()
+
+        self.totals['chapters'] += 1
+        self.totals['pretty_time'] += middle - start
+        self.totals['compact_time'] += end - middle
+        self.totals['pretty_size'] += len(pretty.encode('utf8'))
+        self.totals['compact_size'] += len(compact.encode('utf8'))
+        self.totals['pretty_zipped'] += len(zlib.compress(pretty.encode('utf8')))
+        self.totals['compact_zipped'] += len(zlib.compress(compact.encode('utf8')))
+        return compact
+
+
+def percent(before, after):
+    return f'{100 * (after - before) / before:+.0f}%' if before else '-'
+
+
+@click.command()
+@click.argument('examples', nargs=-1, type=click.Path(exists=True))
+@click.option('--cache/--no-cache', default=True, help="Use the leech cache for pages")
+def run(examples, cache):
+    """Benchmark chapter serialization over EXAMPLES (default: all of examples/)"""
+    examples = examples or sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'examples', '*.json')))
+    session = leech.create_session(cache)
+
+    click.echo(f"{'example':<28}{'chapters':>9}{'prettify':>11}{'compact':>11}{'size':>8}{'zipped':>8}")
+    for example in examples:
+        site = MeasuredArbitrary(session)
+        try:
+            site.extract(example)
+        except Exception as e:
+            click.echo(f"{os.path.basename(example):<28}  failed: {e}")
+            continue
+        totals = site.totals
+        click.echo(
+            f"{os.path.basename(example):<28}{totals['chapters']:>9}"
+            f"{totals['pretty_time']:>10.2f}s{totals['compact_time']:>10.2f}s"
+            f"{percent(totals['pretty_size'], totals['compact_size']):>8}"
+            f"{percent(totals['pretty_zipped'], totals['compact_zipped']):>8}"
+        )
+
+
+if __name__ == '__main__':
+    run()
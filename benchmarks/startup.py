@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Times how long leech takes to start up, and what it imports doing so.
+
+Each case runs in a fresh interpreter, several times over, and the median is
+reported along with which of the slow-to-import packages got imported. Give
+`--against` another checkout of leech (e.g. from `git worktree add`) to
+compare with it. Nothing is fetched. Run from the project directory:
+
+    $ python3 benchmarks/startup.py --runs 10
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+PROJECT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEAVY = ('bs4', 'html5lib', 'lxml', 'requests', 'requests_cache', 'PIL', 'ebook')
+
+# what's run, after sys.path is pointed at the checkout
+CASES = {
+    'leech --help': "import leech; leech.cli(['--help'], standalone_mode=False)",
+    'leech download --help': "import leech; leech.cli(['download', '--help'], standalone_mode=False)",
+    'dispatch a URL': "import leech, sites; sites.get('https://www.royalroad.com/fiction/21220/mother-of-learning')",
+}
+
+REPORT = (
+    "\nimport sys; print(' '.join(m for m in {heavy!r} if m in sys.modules), file=sys.stderr)"
+)
+
+
+def measure(project, code, runs):
+    script = f"import sys; sys.path.insert(0, {project!r})\n{code}" + REPORT.format(heavy=HEAVY)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-c', script], cwd=project,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result.stderr.strip().splitlines()[-1:] or ['']
+
+
+@click.command()
+@click.option('--runs', default=5, help="How many times to run each case")
+@click.option('--against', type=click.Path(exists=True, file_okay=False), help="Another leech checkout to compare with")
+def run(runs, against):
+    """Benchmark leech's startup"""
+    projects = [('this', PROJECT)] + ([('against', against)] if against else [])
+    for case, code in CASES.items():
+        click.echo(case)
+        for name, project in projects:
+            seconds, (imported,) = measure(project, code, runs)
+            click.echo(f"  {name:<8}{seconds:>7.3f}s  imports: {imported or '-'}")
+
+
+if __name__ == '__main__':
+    run()
@@ -1,18 +1,39 @@
-from .epub import make_epub, EpubFile
+from .epub import make_epub, read_epub, sanitize_filename, EpubFile, EpubWriter
 from .cover import make_cover, make_cover_from_url
-from .image import get_image_from_url
+from .image import get_image_from_url, fetch_image, convert_image, GifLimits
 from bs4 import BeautifulSoup
-from sites import Image
+from sites import Image, DEFAULT_PARSER, spill
+from sites.spill import Spill
+from sites.metrics import metrics
+from concurrent.futures import Future, ThreadPoolExecutor
+import collections
+import hashlib
 import html
 import unicodedata
 import datetime
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import uuid
 import attr
+import os
+import re
+import xml.parsers.expat
+
+logger = logging.getLogger(__name__)
+
+# ImagePipeline's pools of image compressing processes, by size; see _process_pool
+_process_pools = {}
+_process_pools_lock = threading.Lock()
 
 html_template = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
 <html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
 <head>
     <title>{title}</title>
-    <link rel="stylesheet" type="text/css" href="../Styles/base.css" />
+    <link rel="stylesheet" type="text/css" href="../Styles/base.css" />{head}
 </head>
 <body>
 <h1>{title}</h1>
@@ -824,70 +845,386 @@ class CoverOptions:
     cover_url = attr.ib(default=None, converter=attr.converters.optional(str))
 
 
-def chapter_html(story, titleprefix=None, normalize=False):
-    chapters = []
+def chapter_html(story, titleprefix=None, normalize=False, parser=None, image_cache=None, session=None, gif_limits=None, _paths=None, _rendered=None, _images=None):
+    """Renders a story's chapters, yielding EpubFiles for them (and their
+    images, and footnotes) one at a time, so they can be written out as they
+    go rather than all being held in memory. Images are downloaded with
+    `session`, and kept in `image_cache` (a sites.store.ImageCache), if
+    there are those; animated GIFs are cut down to `gif_limits`."""
+    # Chapters a StreamingEpub has already rendered (and written the images of), by id
+    rendered = _rendered or {}
+    if _images is None:
+        # The images are downloaded and compressed ahead of the chapters being rendered
+        with ImagePipeline(cache=image_cache, session=session, gif_limits=gif_limits) as images:
+            images.prefetch(_story_image_sources(story, rendered))
+            yield from chapter_html(
+                story, titleprefix=titleprefix, normalize=normalize, parser=parser, _paths=_paths, _rendered=rendered, _images=images)
+        return
+    # Paths already yielded, across any sections; duplicates are not allowed in the format
+    paths = _paths if _paths is not None else set()
     for i, chapter in enumerate(story):
         title = chapter.title or f'#{i}'
         if hasattr(chapter, '__iter__'):
             # This is a Section
-            chapters.extend(chapter_html(
-                chapter, titleprefix=title, normalize=normalize))
+            yield from chapter_html(
+                chapter, titleprefix=title, normalize=normalize, parser=parser, _paths=paths, _rendered=rendered, _images=_images)
         else:
             i += 1
-            soup = BeautifulSoup(chapter.contents, 'html5lib')
-            all_images = soup.find_all('img')
-            len_of_all_images = len(all_images)
-            print(f"Found {len_of_all_images} images in chapter {i}")
-
-            for count, img in enumerate(all_images):
-                count += 1
-                if not img.has_attr('src'):
-                    print(f"Image {count} has no src attribute, skipping...")
-                    continue
-                print(f"[Chapter {i}] Image ({count} out of {len_of_all_images}). Source: ", end="")
-                coverted_image_bytes, ext, mime = get_image_from_url(img['src'])
-                chapter.images.append(Image(
-                    path=f"images/ch{i}_leechimage_{count}.{ext}",
-                    contents=coverted_image_bytes,
-                    content_type=mime
-                ))
-                img['src'] = f"../images/ch{i}_leechimage_{count}.{ext}"
-                if not img.has_attr('alt'):
-                    img['alt'] = f"Image {count} from chapter {i}"
-                if img.has_attr('class'):
-                    img['class'] += " img_center"
-                else:
-                    img['class'] = "img_center"
-            # Add all pictures on this chapter as well.
-            for chapter_image in chapter.images:
-                # For/else syntax, check if the image path already exists, if it doesn't add the image.
-                # Duplicates are not allowed in the format.
-                for other_file in chapters:
-                    if other_file.path == chapter_image.path:
-                        break
-                else:
-                    chapters.append(EpubFile(
-                        path=chapter_image.path, contents=chapter_image.contents, filetype=chapter_image.content_type))
+            if chapter.contents is None:
+                # A placeholder for a chapter that's already in the epub being updated
+                continue
+            prerendered = rendered.get(id(chapter))
+            if prerendered and prerendered[0] is chapter and prerendered[1] == i:
+                contents = spill.load(prerendered[2])
+            else:
+                images, contents = _render_chapter(chapter, i, parser, _images)
+                # Add all pictures on this chapter as well.
+                for chapter_image in images:
+                    if chapter_image.path not in paths:
+                        paths.add(chapter_image.path)
+                        yield EpubFile(
+                            path=chapter_image.path, contents=chapter_image.contents, filetype=chapter_image.content_type)
 
             title = titleprefix and f'{titleprefix}: {title}' or title
-            contents = str(soup)
             if normalize:
                 title = unicodedata.normalize('NFKC', title)
                 contents = unicodedata.normalize('NFKC', contents)
-            chapters.append(EpubFile(
+            yield EpubFile(
                 title=title,
                 path=f'{story.id}/chapter{i}.html',
                 contents=html_template.format(
-                    title=html.escape(title), text=contents)
-            ))
+                    title=html.escape(title), head=_source_meta(chapter.url), text=contents)
+            )
     if story.footnotes:
-        chapters.append(EpubFile(title="Footnotes", path=f'{story.id}/footnotes.html', contents=html_template.format(
-            title="Footnotes", text='\n\n'.join(story.footnotes))))
-    return chapters
+        yield EpubFile(title="Footnotes", path=f'{story.id}/footnotes.html', contents=html_template.format(
+            title="Footnotes", head='', text='\n\n'.join(story.footnotes)))
+
+
+def _source_meta(url):
+    # so an update can tell whether the ebook's chapters are still the story's
+    return url and f'\n    <meta name="dcterms.source" content="{html.escape(url)}" />' or ''
+
+
+def _render_chapter(chapter, i, parser=None, images=None):
+    """Downloads the images in chapter `i` and points it at them.
+
+    Returns the chapter's images (any it already had, then the downloaded
+    ones) and its new contents. The images are kept out of chapter.images,
+    so their bytes can go once they're written. `images` is an
+    ImagePipeline they might already be on their way from.
+    """
+    with metrics.stage('render'):
+        contents = chapter.contents
+        # images the site already downloaded, which the chapter points at already
+        own = {f'../{image.path}' for image in chapter.images}
+        if _is_well_formed(contents):
+            # Most sites hand over BeautifulSoup's own output, which doesn't need
+            # parsing all over again just to find the images in it
+            rewritten = _rewrite_images(contents, i, images, own)
+            if rewritten:
+                downloaded, contents = rewritten
+                return list(chapter.images) + downloaded, contents
+
+        soup = BeautifulSoup(contents, parser or DEFAULT_PARSER)
+        all_images = soup.find_all('img')
+        len_of_all_images = len(all_images)
+        print(f"Found {len_of_all_images} images in chapter {i}")
+
+        downloaded = list(chapter.images)
+        for count, img in enumerate(all_images):
+            count += 1
+            if not img.has_attr('src'):
+                print(f"Image {count} has no src attribute, skipping...")
+                continue
+            if img['src'] not in own:
+                image = _chapter_image(img['src'], i, count, len_of_all_images, images)
+                downloaded.append(image)
+                img['src'] = f"../{image.path}"
+            if not img.has_attr('alt'):
+                img['alt'] = f"Image {count} from chapter {i}"
+            # class is a list of names, so adding a string to it would add each of its letters
+            img['class'] = img.get_attribute_list('class', []) + ["img_center"]
+        return downloaded, str(soup)
+
+
+def _chapter_image(src, i, count, total, images=None):
+    print(f"[Chapter {i}] Image ({count} out of {total}). Source: {'data: URL' if src.startswith('data:') else src}")
+    path = f"images/ch{i}_leechimage_{count}"
+    if images:
+        with metrics.stage('image_wait'):
+            return images.image(src, path)
+    with metrics.stage('image_compress'):
+        coverted_image_bytes, ext, mime = get_image_from_url(src)
+    return Image(
+        path=f"{path}.{ext}",
+        contents=coverted_image_bytes,
+        content_type=mime
+    )
 
 
-def generate_epub(story, cover_options={}, output_filename=None, output_dir=None, normalize=False):
+def _is_well_formed(contents):
+    """Whether contents can go straight into an XHTML page; expat is a lot quicker to ask than html5lib"""
+    try:
+        xml.parsers.expat.ParserCreate().Parse(f'<div>{contents}</div>', True)
+    except xml.parsers.expat.ExpatError:
+        return False
+    return True
+
+
+# HTML doesn't care about case, so neither do these; attribute names are lowercased, as the parsers would
+img_tag_pattern = re.compile(r'''<img((?:\s+[^\s=/>]+(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*)\s*(?:/>|>\s*</img>)''', re.IGNORECASE)
+img_open_pattern = re.compile(r'<img', re.IGNORECASE)
+attribute_pattern = re.compile(r'''([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'))?''')
+
+
+def _rewrite_images(contents, i, images=None, own=()):
+    """Does what _render_chapter does to <img> tags, straight on well-formed
+    contents. Returns None if there are any img tags it can't make sense of."""
+    tags = list(img_tag_pattern.finditer(contents))
+    if len(tags) != len(img_open_pattern.findall(contents)):
+        return None
+    print(f"Found {len(tags)} images in chapter {i}")
+
+    downloaded = []
+    rewritten = []
+    last = 0
+    for count, tag in enumerate(tags, 1):
+        attributes = {
+            match.group(1).lower(): html.unescape(match.group(2) if match.group(2) is not None else match.group(3) or '')
+            for match in attribute_pattern.finditer(tag.group(1))
+        }
+        if 'src' not in attributes:
+            print(f"Image {count} has no src attribute, skipping...")
+            continue
+        if attributes['src'] not in own:
+            image = _chapter_image(attributes['src'], i, count, len(tags), images)
+            downloaded.append(image)
+            attributes['src'] = f"../{image.path}"
+        attributes.setdefault('alt', f"Image {count} from chapter {i}")
+        attributes['class'] = ' '.join(filter(None, (attributes.get('class'), 'img_center')))
+        rewritten.append(contents[last:tag.start()])
+        rewritten.append('<img %s/>' % ' '.join(f'{name}="{html.escape(value)}"' for name, value in attributes.items()))
+        last = tag.end()
+    rewritten.append(contents[last:])
+    return downloaded, ''.join(rewritten)
+
+
+# Loosely, for guessing which images are coming up; _render_chapter has the final say
+img_src_pattern = re.compile(r'''<img\s(?:[^>"']|"[^"]*"|'[^']*')*?\bsrc\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.IGNORECASE)
+
+
+def _chapter_image_sources(chapter):
+    own = {f'../{image.path}' for image in chapter.images}
+    for match in img_src_pattern.finditer(chapter.contents or ''):
+        src = html.unescape(next(group for group in match.groups() if group is not None))
+        if src not in own:
+            yield src
+
+
+def _story_image_sources(story, rendered):
+    """The images chapter_html will want, in the order it'll want them"""
+    for chapter in story:
+        if hasattr(chapter, '__iter__'):
+            yield from _story_image_sources(chapter, rendered)
+        elif chapter.contents is not None and id(chapter) not in rendered:
+            yield from _chapter_image_sources(chapter)
+
+
+def _convert_image(data, file_ext, gif_limits=GifLimits()):
+    # CPU time, as images are compressed several at once
+    start = time.thread_time()
+    return convert_image(data, file_ext, gif_limits, placeholder=False), time.thread_time() - start
+
+
+class ImagePipeline:
+    """Downloads chapter images on a pool of threads, and compresses them on a pool of processes.
+
+    Tell it about images before they're needed with prefetch(), in the order
+    they'll be needed, and up to `window` of them are worked on ahead of
+    time. image() then hands over each one; images it wasn't told about (or
+    which were skipped over) are just fetched then and there. The processes
+    (one per CPU, by default) are shared by every pipeline in the process, and
+    only started once there's an image for them (see _process_pool). With
+    `processes=0`, a single CPU, or in a daemonic process (which can't have
+    children), images are compressed on the downloading threads instead.
+
+    An image is only downloaded once however many times its URL turns up,
+    and only compressed and put in the epub once however many URLs it turns
+    up at, going by a hash of what was downloaded. With a `cache` (a
+    sites.store.ImageCache), compressed images are kept on disk for next time.
+    Images are downloaded with `session`, if there is one; its connection
+    pools want room for `threads` connections to a host. Animated GIFs are
+    cut down to `gif_limits` (an ebook.image.GifLimits).
+    """
+
+    def __init__(self, threads=8, processes=None, window=32, cache=None, session=None, gif_limits=None):
+        self.window = window
+        self.cache = cache
+        self.session = session
+        self.gif_limits = gif_limits or GifLimits()
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.processes = 0 if processes < 2 or multiprocessing.current_process().daemon else processes
+        self._threads = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='image')
+        self._upcoming = iter(())
+        # (src, future) for images being worked on ahead of time, in order
+        self._pending = collections.deque()
+        # src -> future of (hash, future of the compressed image) for every image asked for
+        self._fetches = {}
+        # hash -> future of (what convert_image returns, CPU seconds or None if it came from the cache)
+        self._compressing = {}
+        # hash -> the Image it went in the epub as, without its contents
+        self._placed = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def prefetch(self, sources):
+        with self._lock:
+            self._upcoming = itertools.chain(self._upcoming, sources)
+            self._top_up()
+
+    def image(self, src, path):
+        """The Image for `src`, at `path` plus the extension it ends up with.
+
+        If it's the same as an image already handed over, it's that image's
+        path and no contents instead, as it's already in the epub.
+        """
+        with self._lock:
+            future = None
+            for index, (pending_src, pending) in enumerate(self._pending):
+                if pending_src == src:
+                    # anything before it isn't going to be asked for
+                    for _ in range(index + 1):
+                        _, future = self._pending.popleft()
+                    break
+            if future is None:
+                future = self._submit(src)
+            self._top_up()
+        digest, compressed = future.result()
+        with self._lock:
+            if digest in self._placed:
+                return self._placed[digest]
+        converted, seconds = compressed.result()
+        # a placeholder stands in for anything which couldn't be downloaded or
+        # made sense of; it's not kept, so that it's tried again next time
+        failed = converted is None
+        contents, ext, mime = convert_image(None) if failed else converted
+        image = Image(path=f'{path}.{ext}', contents=contents, content_type=mime)
+        with self._lock:
+            if digest:
+                self._placed[digest] = Image(path=image.path, contents=None, content_type=mime)
+                self._compressing.pop(digest, None)
+                # so that the compressed image can go once it's written
+                self._fetches[_source_key(src)] = _done((digest, None))
+            else:
+                # it couldn't be downloaded, so it's worth another try if it turns up again
+                self._fetches.pop(_source_key(src), None)
+        if seconds is not None:
+            metrics.add_stage('image_compress', seconds)
+            if self.cache and digest and not failed:
+                self.cache.save(None if src.startswith('data:') else src, digest, contents, ext, mime, self._variant)
+        return image
+
+    def close(self):
+        with self._lock:
+            self._upcoming = iter(())
+            for _, future in self._pending:
+                future.cancel()
+            self._pending.clear()
+        self._threads.shutdown()
+
+    def _top_up(self):
+        while len(self._pending) < self.window:
+            src = next(self._upcoming, None)
+            if src is None:
+                return
+            self._pending.append((src, self._submit(src)))
+
+    def _submit(self, src):
+        key = _source_key(src)
+        if key not in self._fetches:
+            self._fetches[key] = self._threads.submit(self._fetch, src)
+        return self._fetches[key]
+
+    def _fetch(self, src):
+        digest = data = None
+        if self.cache and not src.startswith('data:'):
+            digest = self.cache.digest(src)
+        if digest is None:
+            data, file_ext = fetch_image(src, self.session)
+            if data is None:
+                # nothing to go by, so a placeholder of its own
+                return None, _done(_convert_image(None, None))
+            digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if digest in self._placed:
+                return digest, None
+            if digest in self._compressing:
+                return digest, self._compressing[digest]
+            compressed = self._compressing[digest] = Future()
+        try:
+            stored = self.cache and self.cache.load(digest, self._variant)
+            if stored:
+                compressed.set_result((stored, None))
+                return digest, compressed
+            if data is None:
+                # the cache knew the URL, but not what was at it
+                data, file_ext = fetch_image(src, self.session)
+            compressed.set_result(self._compress(data, file_ext))
+        except BaseException as e:
+            compressed.set_exception(e)
+        return digest, compressed
+
+    def _compress(self, data, file_ext):
+        if self.processes == 0:
+            return _convert_image(data, file_ext, self.gif_limits)
+        return _process_pool(self.processes).submit(_convert_image, data, file_ext, self.gif_limits).result()
+
+    @property
+    def _variant(self):
+        # GIFs come out differently with limits, so they're cached separately
+        if not self.gif_limits:
+            return ''
+        return f'gif:{self.gif_limits.frames or ""}:{self.gif_limits.seconds or ""}'
+
+
+def _process_pool(processes):
+    """The pool of `processes` processes which every ImagePipeline asking for
+    that many shares, started the first time it's needed.
+
+    Its processes are started fresh (forkserver, or spawn where there's no
+    forkserver) rather than forked, as by then this process has threads of
+    its own, which can leave a forked child stuck on a lock one of them held.
+    The pool lasts as long as this process does.
+    """
+    with _process_pools_lock:
+        if processes not in _process_pools:
+            from concurrent.futures import ProcessPoolExecutor
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _process_pools[processes] = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(method))
+        return _process_pools[processes]
+
+
+def _source_key(src):
+    # data: URLs are the whole image, which needn't be kept around just to recognize it
+    return hashlib.sha256(src.encode('utf8')).hexdigest() if src.startswith('data:') else src
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def story_metadata(story, started=None):
     dates = list(story.dates())
+    if started:
+        dates.append(started)
     metadata = {
         'title': story.title,
         'author': story.author,
@@ -906,7 +1243,27 @@ def generate_epub(story, cover_options={}, output_filename=None, output_dir=None
     if extra_metadata:
         metadata['extra'] = '\n        '.join(
             f'<dt>{k}</dt><dd>{v}</dd>' for k, v in extra_metadata.items())
-
+    return metadata
+
+
+def generate_epub(
+    story, cover_options={}, output_filename=None, output_dir=None, normalize=False, parser=None,
+    image_cache=None, session=None, gif_limits=None
+):
+    metadata = story_metadata(story)
+    # Chapters are rendered as make_epub gets to them, so only one is in memory at a time
+    with metrics.stage('zip_write'):
+        return make_epub(
+            output_filename or story.title + '.epub',
+            _epub_files(
+                story, metadata, cover_options, normalize=normalize, parser=parser,
+                image_cache=image_cache, session=session, gif_limits=gif_limits),
+            metadata,
+            output_dir=output_dir
+        )
+
+
+def _epub_files(story, metadata, cover_options, normalize=False, parser=None, image_cache=None, session=None, gif_limits=None, _paths=None, _rendered=None, _images=None):
     valid_cover_options = ('fontname', 'fontsize', 'width',
                            'height', 'wrapat', 'bgcolor', 'textcolor', 'cover_url')
     cover_options = CoverOptions(
@@ -916,20 +1273,23 @@ def generate_epub(story, cover_options={}, output_filename=None, output_dir=None
 
     if cover_options and "cover_url" in cover_options:
         image = make_cover_from_url(
-            cover_options["cover_url"], story.title, story.author)
+            cover_options["cover_url"], story.title, story.author, session=session)
     elif story.cover_url:
-        image = make_cover_from_url(story.cover_url, story.title, story.author)
+        image = make_cover_from_url(story.cover_url, story.title, story.author, session=session)
     else:
         image = make_cover(story.title, story.author, **cover_options)
 
-    return make_epub(
-        output_filename or story.title + '.epub',
+    return itertools.chain(
         [
             # The cover is static, and the only change comes from the image which we generate
             EpubFile(title='Cover', path='cover.html', contents=cover_template),
             EpubFile(title='Front Matter', path='frontmatter.html', contents=frontmatter_template.format(
                 now=datetime.datetime.now(), **metadata)),
-            *chapter_html(story, normalize=normalize),
+        ],
+        chapter_html(
+            story, normalize=normalize, parser=parser, image_cache=image_cache, session=session, gif_limits=gif_limits,
+            _paths=_paths, _rendered=_rendered, _images=_images),
+        [
             EpubFile(
                 path='Styles/base.css',
                 contents=css_styles,
@@ -938,6 +1298,252 @@ def generate_epub(story, cover_options={}, output_filename=None, output_dir=None
             EpubFile(path='images/cover.png',
                      contents=image.read(), filetype='image/png'),
         ],
-        metadata,
-        output_dir=output_dir
     )
+
+
+class StreamingEpub:
+    """Renders and writes a story's chapters into an epub while the rest of
+    the story is still being downloaded.
+
+    A site hands over each chapter as it's extracted (see Site.chapter_sink).
+    Chapters are rendered on one thread and their images written into the zip
+    on another, with bounded queues between the stages, so whichever stage is
+    slowest holds the others back rather than letting work pile up. finish()
+    adds everything which needs the whole story: the front matter, chapter
+    pages, footnotes, cover and index. Until then the rendered chapters wait
+    in a temporary file of their own, rather than in memory.
+
+    The chapters are assumed to be the story's top-level chapters, in order.
+    If the finished story doesn't line up with them, it's written again from
+    scratch by generate_epub.
+    """
+
+    def __init__(self, output_dir=None, normalize=False, parser=None, queue_size=8, image_cache=None, session=None, gif_limits=None):
+        self.output_dir = output_dir
+        self.normalize = normalize
+        self.parser = parser
+        self.image_cache = image_cache
+        self.session = session
+        self.gif_limits = gif_limits
+        self.writer = EpubWriter(f'leech-{uuid.uuid4().hex}.partial', output_dir=output_dir)
+        self._chapters = queue.Queue(queue_size)
+        self._files = queue.Queue(queue_size)
+        self._paths = set()
+        # id(chapter) -> the chapter, its number, and where its rendered contents are in _spill
+        self._rendered = {}
+        self._spill = Spill(threshold=1)
+        self._error = None
+        # kept until finish(), so that images are only added once across both
+        self._images = ImagePipeline(cache=image_cache, session=session, gif_limits=gif_limits)
+        self._threads = [
+            threading.Thread(target=self._render, daemon=True),
+            threading.Thread(target=self._write, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def add_chapter(self, chapter):
+        # its images can be on their way while it waits its turn to be rendered
+        self._images.prefetch(_chapter_image_sources(chapter))
+        self._chapters.put(chapter)
+
+    def finish(self, story, cover_options={}, output_filename=None):
+        """Writes out the rest of the epub, now that `story` is complete, and returns its filename"""
+        self._join()
+        if self._error or any(i > len(story) or story[i - 1] is not chapter for chapter, i, _ in self._rendered.values()):
+            if self._error:
+                logger.warning("Couldn't render chapters as they came in, starting over: %s", self._error)
+            self.writer.abort()
+            self._images.close()
+            self._spill.close()
+            return generate_epub(
+                story, cover_options, output_filename=output_filename, output_dir=self.output_dir,
+                normalize=self.normalize, parser=self.parser, image_cache=self.image_cache, session=self.session,
+                gif_limits=self.gif_limits)
+
+        metadata = story_metadata(story)
+        with self._images:
+            self._images.prefetch(_story_image_sources(story, self._rendered))
+            files = _epub_files(
+                story, metadata, cover_options, normalize=self.normalize, parser=self.parser, session=self.session,
+                _paths=self._paths, _rendered=self._rendered, _images=self._images
+            )
+            for file in files:
+                with metrics.stage('zip_write'):
+                    self.writer.add(file)
+        self._spill.close()
+        filename = sanitize_filename(output_filename or story.title + '.epub')
+        if self.output_dir:
+            filename = os.path.join(self.output_dir, filename)
+        with metrics.stage('zip_write'):
+            os.replace(self.writer.close(metadata), filename)
+        return filename
+
+    def abort(self):
+        self._join()
+        self._images.close()
+        self._spill.close()
+        self.writer.abort()
+
+    def _join(self):
+        self._chapters.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _render(self):
+        for i, chapter in enumerate(iter(self._chapters.get, None), 1):
+            if self._error:
+                # keep taking chapters, so the site doesn't block on a full queue
+                continue
+            try:
+                images, contents = _render_chapter(chapter, i, self.parser, self._images)
+                for image in images:
+                    if image.path not in self._paths:
+                        self._paths.add(image.path)
+                        self._files.put(EpubFile(path=image.path, contents=image.contents, filetype=image.content_type))
+                self._rendered[id(chapter)] = (chapter, i, self._spill.store(contents))
+            except Exception as e:
+                self._error = e
+        self._files.put(None)
+
+    def _write(self):
+        for file in iter(self._files.get, None):
+            if self._error:
+                continue
+            try:
+                with metrics.stage('zip_write'):
+                    self.writer.add(file)
+            except Exception as e:
+                self._error = e
+
+
+@attr.s
+class ExistingEpub:
+    """An epub made by an earlier run, which is being updated with new chapters."""
+    filename = attr.ib()
+    meta = attr.ib()
+    files = attr.ib()
+
+    @property
+    def url(self):
+        return self.meta['unique_id']
+
+    @property
+    def chapter_paths(self):
+        return [file.path for file in self._chapter_files()]
+
+    @property
+    def chapter_urls(self):
+        """Where each chapter came from, or None where the ebook doesn't say (as older ones don't)"""
+        urls = []
+        for file in self._chapter_files():
+            match = re.search(r'<meta name="dcterms.source" content="([^"]*)"', file.contents.decode('utf8'))
+            urls.append(match and html.unescape(match.group(1)))
+        return urls
+
+    @property
+    def chapter_titles(self):
+        return [file.title for file in self._chapter_files()]
+
+    def _chapter_files(self):
+        return [file for file in self.files if re.match(r'^[^/]+/chapter\d+\.html$', file.path)]
+
+    def footnotes(self, parser=None):
+        """The ebook's footnotes, parsed as the site's pages would be, so the new chapters' are numbered after them"""
+        for file in self.files:
+            if file.path.endswith('/footnotes.html'):
+                # skip the xml declaration, so bs4 doesn't warn about parsing xml as html
+                soup = BeautifulSoup(re.sub(r'^<\?xml[^>]*\?>', '', file.contents.decode('utf8')), parser or DEFAULT_PARSER)
+                return [str(note) for note in soup.find_all('div', id=re.compile(r'^footnote\d+$'))]
+        return []
+
+    @property
+    def started(self):
+        for file in self.files:
+            if file.path == 'frontmatter.html':
+                match = re.search(r'<dt>Started</dt>\s*<dd>(\d{4}-\d{2}-\d{2})</dd>', file.contents.decode('utf8'))
+                if match:
+                    return datetime.datetime.strptime(match.group(1), '%Y-%m-%d')
+
+
+def read_existing_epub(filename):
+    meta, files = read_epub(filename)
+    return ExistingEpub(filename=filename, meta=meta, files=files)
+
+
+def update_epub(story, existing, normalize=False, parser=None, image_cache=None, session=None, gif_limits=None):
+    """Adds a story's new chapters to the epub it was previously written to.
+
+    The first chapters of `story`, as many as the epub already has, are left
+    as they are in the epub; everything else is rendered and added after them,
+    and the front matter and footnotes are rewritten. Zip entries can't be
+    replaced in place, so the archive is rebuilt from its existing entries.
+
+    Returns the number of chapters added, or None (leaving the epub alone) if
+    its chapters aren't the first of the story's any more, in which case it
+    needs making again with rebuild_epub.
+    """
+    chapter_paths = existing.chapter_paths
+    if any(not path.startswith(f'{story.id}/') for path in chapter_paths):
+        raise Exception(f"{existing.filename} doesn't look like it was made from {story.url}")
+    if not _same_chapters(story, existing, normalize):
+        return None
+    if len(story) == len(chapter_paths):
+        return 0
+    for chapter in story[:len(chapter_paths)]:
+        # Sites which can't skip fetching these will have filled them in anyway
+        chapter.contents = None
+
+    footnotes_path = f'{story.id}/footnotes.html'
+    frontmatter = EpubFile(title='Front Matter', path='frontmatter.html', contents=frontmatter_template.format(
+        now=datetime.datetime.now(), **story_metadata(story, started=existing.started)))
+
+    def files():
+        for file in existing.files:
+            if file.path == 'frontmatter.html':
+                yield frontmatter
+            elif file.path != footnotes_path:
+                yield file
+            if file.path == (chapter_paths[-1] if chapter_paths else 'frontmatter.html'):
+                # rendered as they're written, like generate_epub does
+                yield from chapter_html(
+                    story, normalize=normalize, parser=parser, image_cache=image_cache, session=session, gif_limits=gif_limits)
+
+    output_dir, filename = os.path.split(existing.filename)
+    with metrics.stage('zip_write'):
+        filename = make_epub(filename + '.new', files(), existing.meta, output_dir=output_dir)
+    os.replace(filename, existing.filename)
+    return len(story) - len(chapter_paths)
+
+
+def _same_chapters(story, existing, normalize=False):
+    """Whether the epub's chapters are the first of the story's, going by
+    their URLs, or their titles where there's no URL to go by"""
+    if len(story) < len(existing.chapter_paths):
+        return False
+    for chapter, url, title in zip(story, existing.chapter_urls, existing.chapter_titles):
+        if chapter.url and url:
+            if chapter.url != url:
+                return False
+        elif chapter.title and title:
+            # as chapter_html titled it
+            if (unicodedata.normalize('NFKC', chapter.title) if normalize else chapter.title) != title:
+                return False
+    return True
+
+
+def rebuild_epub(story, existing, cover_options={}, normalize=False, parser=None, image_cache=None, session=None, gif_limits=None):
+    """Makes an epub over again from the whole of `story`, for when update_epub can't just add to it.
+
+    Every chapter has to have its contents. The story is still counted as
+    started when the epub says it was.
+    """
+    metadata = story_metadata(story, started=existing.started)
+    output_dir, filename = os.path.split(existing.filename)
+    files = _epub_files(
+        story, metadata, cover_options, normalize=normalize, parser=parser,
+        image_cache=image_cache, session=session, gif_limits=gif_limits)
+    with metrics.stage('zip_write'):
+        filename = make_epub(filename + '.new', files, metadata, output_dir=output_dir)
+    os.replace(filename, existing.filename)
+    return len(story)
@@ -2,7 +2,6 @@
 from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
 import textwrap
-import requests
 import logging
 
 logger = logging.getLogger(__name__)
@@ -32,11 +31,17 @@ def make_cover(title, author, width=600, height=800, fontname="Helvetica", fonts
     return output
 
 
-def make_cover_from_url(url, title, author):
+def make_cover_from_url(url, title, author, session=None):
+    # Imported here so that this module can still be run on its own, as below
+    from .image import fetch_image
+
     try:
         logger.info("Downloading cover from " + url)
-        img = requests.Session().get(url)
-        cover = BytesIO(img.content)
+        # waits its turn with the rate limiter, and tries again if it has to
+        data, _ = fetch_image(url, session)
+        if data is None:
+            raise ValueError("Nothing was downloaded")
+        cover = BytesIO(data)
 
         imgformat = Image.open(cover).format
         # The `Image.open` read a few bytes from the stream to work out the
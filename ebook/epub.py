@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import os.path
+import shutil
 import zipfile
 import xml.etree.ElementTree as etree
 import uuid
@@ -16,6 +17,8 @@ This totally started from http://www.manuel-strehl.de/dev/simple_epub_ebooks_wit
 
 
 EpubFile = namedtuple('EbookFile', 'path, contents, title, filetype', defaults=(False, False, "application/xhtml+xml"))
+# An EpubFile's contents can be one of these, to be copied straight from an entry of another zip
+ZipEntry = namedtuple('ZipEntry', 'filename, name')
 
 
 def sanitize_filename(s):
@@ -36,115 +39,203 @@ def sanitize_filename(s):
 
 
 def make_epub(filename, files, meta, compress=True, output_dir=False):
-    unique_id = meta.get('unique_id', False)
-    if not unique_id:
-        unique_id = 'leech_book_' + str(uuid.uuid4())
-
-    filename = sanitize_filename(filename)
-    if output_dir:
-        filename = os.path.join(output_dir, filename)
-    epub = zipfile.ZipFile(filename, 'w', compression=compress and zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED)
-
-    # The first file must be named "mimetype", and shouldn't be compressed
-    epub.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
-
-    # We need an index file, that lists all other HTML files
-    # This index file itself is referenced in the META_INF/container.xml
-    # file
-    container = etree.Element('container', version="1.0", xmlns="urn:oasis:names:tc:opendocument:xmlns:container")
-    rootfiles = etree.SubElement(container, 'rootfiles')
-    etree.SubElement(rootfiles, 'rootfile', {
-        'full-path': "OEBPS/Content.opf",
-        'media-type': "application/oebps-package+xml",
-    })
-    epub.writestr("META-INF/container.xml", etree.tostring(container))
-
-    package = etree.Element('package', {
-        'version': "2.0",
-        'xmlns': "http://www.idpf.org/2007/opf",
-        'unique-identifier': 'book_identifier',  # could plausibly be based on the name
-    })
-
-    # build the metadata
-    metadata = etree.SubElement(package, 'metadata', {
-        'xmlns:dc': "http://purl.org/dc/elements/1.1/",
-        'xmlns:opf': "http://www.idpf.org/2007/opf",
-    })
-    identifier = etree.SubElement(metadata, 'dc:identifier', id='book_identifier')
-    if unique_id.find('://') != -1:
-        identifier.set('opf:scheme', "URI")
-    identifier.text = unique_id
-    etree.SubElement(metadata, 'dc:title').text = meta.get('title', 'Untitled')
-    etree.SubElement(metadata, 'dc:language').text = meta.get('language', 'en')
-    etree.SubElement(metadata, 'dc:creator', {'opf:role': 'aut'}).text = meta.get('author', 'Unknown')
-    etree.SubElement(metadata, 'meta', {'name': 'generator', 'content': 'leech'})
-
-    # we'll need a manifest and spine
-    manifest = etree.SubElement(package, 'manifest')
-    spine = etree.SubElement(package, 'spine', toc="ncx")
-    guide = etree.SubElement(package, 'guide')
-
-    # ...and the ncx index
-    ncx = etree.Element('ncx', {
-        'xmlns': "http://www.daisy.org/z3986/2005/ncx/",
-        'version': "2005-1",
-        'xml:lang': "en-US",
-    })
-    etree.SubElement(etree.SubElement(ncx, 'head'), 'meta', name="dtb:uid", content=unique_id)
-    etree.SubElement(etree.SubElement(ncx, 'docTitle'), 'text').text = meta.get('title', 'Untitled')
-    etree.SubElement(etree.SubElement(ncx, 'docAuthor'), 'text').text = meta.get('author', 'Unknown')
-    navmap = etree.SubElement(ncx, 'navMap')
-
-    # Write each HTML file to the ebook, collect information for the index
-    for i, file in enumerate(files):
-        file_id = 'file_%d' % (i + 1)
-        etree.SubElement(manifest, 'item', {
-            'id': file_id,
-            'href': file.path,
-            'media-type': file.filetype,
+    epub = EpubWriter(filename, compress=compress, output_dir=output_dir)
+    for file in files:
+        epub.add(file)
+    return epub.close(meta)
+
+
+class EpubWriter:
+    """Writes an epub one file at a time.
+
+    Each file goes into the zip as soon as it's added, and only its path,
+    title and type are kept for the index, which is written out by close().
+    Files end up in the manifest and spine in the order they're added.
+    """
+
+    def __init__(self, filename, compress=True, output_dir=False):
+        filename = sanitize_filename(filename)
+        if output_dir:
+            filename = os.path.join(output_dir, filename)
+        self.filename = filename
+        self.files = []
+        # zips which ZipEntry contents are being copied from, by filename
+        self._sources = {}
+        self.epub = zipfile.ZipFile(filename, 'w', compression=compress and zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED)
+
+        # The first file must be named "mimetype", and shouldn't be compressed
+        self.epub.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+
+        # We need an index file, that lists all other HTML files
+        # This index file itself is referenced in the META_INF/container.xml
+        # file
+        container = etree.Element('container', version="1.0", xmlns="urn:oasis:names:tc:opendocument:xmlns:container")
+        rootfiles = etree.SubElement(container, 'rootfiles')
+        etree.SubElement(rootfiles, 'rootfile', {
+            'full-path': "OEBPS/Content.opf",
+            'media-type': "application/oebps-package+xml",
+        })
+        self.epub.writestr("META-INF/container.xml", etree.tostring(container))
+
+    def add(self, file):
+        # Add the actual html to the zip; the index only needs to know about it
+        if isinstance(file.contents, ZipEntry):
+            self._copy(file.contents, 'OEBPS/' + file.path)
+        elif file.contents:
+            self.epub.writestr('OEBPS/' + file.path, file.contents)
+        else:
+            self.epub.write(file.path, 'OEBPS/' + file.path)
+        self.files.append(file._replace(contents=None))
+
+    def _copy(self, entry, name):
+        """Copies a ZipEntry into the epub a chunk at a time, rather than reading it all in first"""
+        if entry.filename not in self._sources:
+            self._sources[entry.filename] = zipfile.ZipFile(entry.filename)
+        with self._sources[entry.filename].open(entry.name) as source, self.epub.open(name, 'w') as destination:
+            shutil.copyfileobj(source, destination)
+
+    def _close_sources(self):
+        for source in self._sources.values():
+            source.close()
+        self._sources.clear()
+
+    def abort(self):
+        """Gives up on the epub, removing what's been written so far"""
+        self._close_sources()
+        self.epub.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def close(self, meta):
+        unique_id = meta.get('unique_id', False)
+        if not unique_id:
+            unique_id = 'leech_book_' + str(uuid.uuid4())
+
+        package = etree.Element('package', {
+            'version': "2.0",
+            'xmlns': "http://www.idpf.org/2007/opf",
+            'unique-identifier': 'book_identifier',  # could plausibly be based on the name
         })
-        if file.filetype == "application/xhtml+xml":
-            itemref = etree.SubElement(spine, 'itemref', idref=file_id)
-            point = etree.SubElement(navmap, 'navPoint', {
-                'class': "h1",
-                'id': file_id,
-            })
-            etree.SubElement(etree.SubElement(point, 'navLabel'), 'text').text = file.title
-            etree.SubElement(point, 'content', src=file.path)
 
-        if 'cover.html' == os.path.basename(file.path):
-            etree.SubElement(guide, 'reference', {
-                'type': 'cover',
-                'title': 'Cover',
+        # build the metadata
+        metadata = etree.SubElement(package, 'metadata', {
+            'xmlns:dc': "http://purl.org/dc/elements/1.1/",
+            'xmlns:opf': "http://www.idpf.org/2007/opf",
+        })
+        identifier = etree.SubElement(metadata, 'dc:identifier', id='book_identifier')
+        if unique_id.find('://') != -1:
+            identifier.set('opf:scheme', "URI")
+        identifier.text = unique_id
+        etree.SubElement(metadata, 'dc:title').text = meta.get('title', 'Untitled')
+        etree.SubElement(metadata, 'dc:language').text = meta.get('language', 'en')
+        etree.SubElement(metadata, 'dc:creator', {'opf:role': 'aut'}).text = meta.get('author', 'Unknown')
+        etree.SubElement(metadata, 'meta', {'name': 'generator', 'content': 'leech'})
+
+        # we'll need a manifest and spine
+        manifest = etree.SubElement(package, 'manifest')
+        spine = etree.SubElement(package, 'spine', toc="ncx")
+        guide = etree.SubElement(package, 'guide')
+
+        # ...and the ncx index
+        ncx = etree.Element('ncx', {
+            'xmlns': "http://www.daisy.org/z3986/2005/ncx/",
+            'version': "2005-1",
+            'xml:lang': "en-US",
+        })
+        etree.SubElement(etree.SubElement(ncx, 'head'), 'meta', name="dtb:uid", content=unique_id)
+        etree.SubElement(etree.SubElement(ncx, 'docTitle'), 'text').text = meta.get('title', 'Untitled')
+        etree.SubElement(etree.SubElement(ncx, 'docAuthor'), 'text').text = meta.get('author', 'Unknown')
+        navmap = etree.SubElement(ncx, 'navMap')
+
+        # Collect information for the index from each file written
+        for i, file in enumerate(self.files):
+            file_id = 'file_%d' % (i + 1)
+            etree.SubElement(manifest, 'item', {
+                'id': file_id,
                 'href': file.path,
+                'media-type': file.filetype,
             })
-            itemref.set('linear', 'no')
-        if 'images/cover.png' == file.path:
-            etree.SubElement(metadata, 'meta', {
-                'name': 'cover',
-                'content': file_id,
-            })
+            if file.filetype == "application/xhtml+xml":
+                itemref = etree.SubElement(spine, 'itemref', idref=file_id)
+                point = etree.SubElement(navmap, 'navPoint', {
+                    'class': "h1",
+                    'id': file_id,
+                })
+                etree.SubElement(etree.SubElement(point, 'navLabel'), 'text').text = file.title
+                etree.SubElement(point, 'content', src=file.path)
+
+            if 'cover.html' == os.path.basename(file.path):
+                etree.SubElement(guide, 'reference', {
+                    'type': 'cover',
+                    'title': 'Cover',
+                    'href': file.path,
+                })
+                itemref.set('linear', 'no')
+            if 'images/cover.png' == file.path:
+                etree.SubElement(metadata, 'meta', {
+                    'name': 'cover',
+                    'content': file_id,
+                })
+
+        # ...and add the ncx to the manifest
+        etree.SubElement(manifest, 'item', {
+            'id': 'ncx',
+            'href': 'toc.ncx',
+            'media-type': "application/x-dtbncx+xml",
+        })
+        self.epub.writestr('OEBPS/toc.ncx', etree.tostring(ncx))
 
-        # and add the actual html to the zip
-        if file.contents:
-            epub.writestr('OEBPS/' + file.path, file.contents)
-        else:
-            epub.write(file.path, 'OEBPS/' + file.path)
+        # Finally, write the index
+        self.epub.writestr('OEBPS/Content.opf', etree.tostring(package))
 
-    # ...and add the ncx to the manifest
-    etree.SubElement(manifest, 'item', {
-        'id': 'ncx',
-        'href': 'toc.ncx',
-        'media-type': "application/x-dtbncx+xml",
-    })
-    epub.writestr('OEBPS/toc.ncx', etree.tostring(ncx))
+        self._close_sources()
+        self.epub.close()
 
-    # Finally, write the index
-    epub.writestr('OEBPS/Content.opf', etree.tostring(package))
+        return self.filename
 
-    epub.close()
 
-    return filename
+def read_epub(filename):
+    """Read back an epub made by make_epub.
+
+    Returns its metadata and a list of EpubFiles, in manifest order. The
+    pages' contents are read in as bytes; anything else (images, stylesheets)
+    is left in the zip, as a ZipEntry for EpubWriter to copy across.
+    """
+    ns = {
+        'opf': "http://www.idpf.org/2007/opf",
+        'dc': "http://purl.org/dc/elements/1.1/",
+        'ncx': "http://www.daisy.org/z3986/2005/ncx/",
+    }
+    with zipfile.ZipFile(filename) as epub:
+        package = etree.fromstring(epub.read('OEBPS/Content.opf'))
+        ncx = etree.fromstring(epub.read('OEBPS/toc.ncx'))
+
+        titles = {}
+        for point in ncx.iterfind('.//ncx:navPoint', ns):
+            titles[point.find('ncx:content', ns).get('src')] = point.findtext('ncx:navLabel/ncx:text', namespaces=ns)
+
+        metadata = package.find('opf:metadata', ns)
+        meta = {
+            'unique_id': metadata.findtext('dc:identifier', namespaces=ns),
+            'title': metadata.findtext('dc:title', namespaces=ns),
+            'author': metadata.findtext('dc:creator', namespaces=ns),
+            'language': metadata.findtext('dc:language', namespaces=ns),
+        }
+
+        files = []
+        for item in package.find('opf:manifest', ns):
+            if item.get('id') == 'ncx':
+                continue
+            path = item.get('href')
+            filetype = item.get('media-type')
+            files.append(EpubFile(
+                path=path,
+                contents=epub.read('OEBPS/' + path) if filetype == "application/xhtml+xml" else ZipEntry(filename, 'OEBPS/' + path),
+                title=titles.get(path, False),
+                filetype=filetype
+            ))
+
+    return meta, files
 
 
 if __name__ == '__main__':
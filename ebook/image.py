@@ -1,15 +1,37 @@
+import functools
 import math
 
 import PIL.Image
-from PIL import Image, ImageDraw, ImageFont
+from PIL import GifImagePlugin, Image, ImageChops, ImageDraw, ImageFont, ImageSequence
 from io import BytesIO
 from base64 import b64decode
 import textwrap
 import requests
 import logging
+import time
+import attr
+from sites import host_slot, rate_limiter
+from sites.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+# (connect, read) seconds to wait on an image before giving up on it
+TIMEOUT = (10, 60)
+# Statuses worth trying an image again after, and how many times to
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRIES = 3
+
+
+@attr.s(frozen=True)
+class GifLimits:
+    """How much of an animated GIF to keep: frames past either limit are
+    dropped, and `frames=1` makes it a still of its first frame"""
+    frames = attr.ib(default=None)
+    seconds = attr.ib(default=None)
+
+    def __bool__(self):
+        return bool(self.frames or self.seconds)
+
 
 def make_image(
     message: str,
@@ -43,50 +65,67 @@ def make_image(
     return output
 
 
+# How big images are meant to end up, by how big they were downloaded: (at least this many bytes, target bytes)
+TARGET_LENGTHS = (
+    (1024 * 1024, 250_000),
+    (200 * 1024, 175_000),
+    (0, 100_000),
+)
+# ...and how many pixels that comes to
+PIXELS_PER_BYTE = 2.8114
+
+
+def target_length(length):
+    """How many bytes an image which was `length` bytes is meant to end up"""
+    return next(target for at_least, target in TARGET_LENGTHS if length >= at_least)
+
+
+def target_size(dimensions, length):
+    """
+    What an image should be shrunk to, going by its header alone
+    @param dimensions: The image's width and height
+    @param length: How many bytes the image was
+    @return: The new width and height, or None if it's small enough already
+    """
+    target_pixel_count = PIXELS_PER_BYTE * target_length(length)
+    if math.prod(dimensions) <= target_pixel_count:
+        return None
+    # both sides shrink by the same amount, so the pixel count shrinks by its square
+    scale_factor = math.sqrt(target_pixel_count / math.prod(dimensions))
+    return tuple(max(1, int(scale_factor * dim)) for dim in dimensions)
+
+
 def compress_image(image: BytesIO) -> PIL.Image.Image:
-    image_size = get_size_format(len(image.getvalue()))
-    logger.info(f"Image size: {image_size}")
-
-    big_photo = Image.open(image).convert("RGBA")
-
-    if image_size[-2:] == "MB":
-        target_pixel_count = 2.8114 * 250_000
-        logger.info("Image is MB, compressing with target size of 250KB")
-    elif image_size[-2:] == "KB" and int(float(image_size[:-2])) > 200:
-        target_pixel_count = 2.8114 * 175_000
-        logger.info("Image is greater than 200KB, compressing with target size of 175KB")
-    else:
-        target_pixel_count = 2.8114 * 100_000
-    scale_factor = target_pixel_count / math.prod(big_photo.size)
-    if scale_factor < 1:
-        x, y = tuple(int(scale_factor * dim) for dim in big_photo.size)
-        logger.info(f"Resizing image dimensions from {big_photo.size} to ({x}, {y})")
-        sml_photo = big_photo.resize((x, y), resample=Image.LANCZOS)
-    else:
-        sml_photo = big_photo
-    return sml_photo
+    logger.info(f"Image size: {get_size_format(len(image.getvalue()))}")
+
+    # Nothing is decoded until it's needed, so this is just the header
+    photo = Image.open(image)
+    size = target_size(photo.size, len(image.getvalue()))
+    if size:
+        logger.info(f"Resizing image dimensions from {photo.size} to {size}")
+        # JPEGs can be decoded at 1/2, 1/4 or 1/8 of their size for much less
+        # than the whole thing; no smaller than `size`, though, so there's
+        # still some resampling to do
+        photo.draft(photo.mode, size)
+        if photo.mode not in ("RGB", "L", "RGBA"):
+            # palette images, e.g., can't be resampled as they are
+            photo = photo.convert("RGBA")
+        # reducing_gap shrinks it most of the way with a cheap box filter first
+        photo = photo.resize(size, resample=Image.LANCZOS, reducing_gap=3.0)
+    return photo.convert("RGBA")
 
 
 def PIL_Image_to_bytes(
     pil_image: PIL.Image.Image,
     image_format: str,
     image_bytes: bytes,
-    print_new_image_size: bool = False
+    print_new_image_size: bool = False,
+    gif_limits: GifLimits = GifLimits()
 ) -> bytes:
     out_io = BytesIO()
     if image_format.lower().startswith("gif"):
-        # pil_image.save(out_io, save_all=True, format=image_format, optimize=True, loop=0)
         logger.info(f"Original image size: {get_size_format(len(image_bytes))}")
-        frames = []
-        current = pil_image.convert('RGBA')
-        while True:
-            try:
-                frames.append(current)
-                pil_image.seek(pil_image.tell() + 1)
-                current = Image.alpha_composite(current, pil_image.convert('RGBA'))
-            except EOFError:
-                break
-        frames[0].save(out_io, format=image_format, save_all=True, append_images=frames[1:], optimize=True, loop=0)
+        _write_gif(pil_image, out_io, gif_limits)
         if print_new_image_size:
             logger.info(f"Final image size: {get_size_format(len(out_io.getvalue()))}")
         return out_io.getvalue()
@@ -100,43 +139,153 @@ def PIL_Image_to_bytes(
     return out_io.getvalue()
 
 
-def get_image_from_url(url: str):
+def _write_gif(pil_image, out_io, limits):
+    """
+    Writes out an animated GIF a frame at a time, so however long it is
+    only a couple of frames of it are ever in memory.
+    Pillow hands over each frame with the ones before it already drawn in.
+    Each is flattened onto white, and only the part of it which changed
+    since the frame before is written, in the first frame's colors if it
+    can be; a frame which didn't change at all just lengthens the last one.
+    """
+    seconds = 0
+    # the last frame in full, and what's to be written of it once its duration is known
+    previous = pending = None
+    for index, frame in enumerate(ImageSequence.Iterator(pil_image)):
+        if index and (limits.frames and index >= limits.frames or limits.seconds and seconds >= limits.seconds):
+            logger.info(f"Keeping {index} frames of the GIF ({seconds:.1f}s)")
+            break
+        duration = frame.info.get("duration", 0)
+        seconds += duration / 1000
+        frame = frame.convert("RGBA")
+        still = Image.new("RGB", frame.size, "white")
+        still.paste(frame, (0, 0), frame)
+        if previous is None:
+            palette = still.convert("P", palette=Image.ADAPTIVE)
+            header, _ = GifImagePlugin.getheader(palette, info={"loop": 0})
+            out_io.writelines(header)
+            colors = {color for _, color in palette.convert("RGB").getcolors(256)}
+            bbox = (0, 0) + still.size
+        else:
+            bbox = ImageChops.difference(previous, still).getbbox()
+            if bbox is None:
+                pending["duration"] += duration
+                continue
+        if pending:
+            out_io.writelines(GifImagePlugin.getdata(**pending))
+        pending = dict(_gif_frame(still.crop(bbox), palette, colors), offset=bbox[:2], duration=duration, disposal=1)
+        previous = still
+    if pending:
+        out_io.writelines(GifImagePlugin.getdata(**pending))
+    out_io.write(b";")
+
+
+def _gif_frame(part, palette, colors):
+    used = part.getcolors(256)
+    if used is not None and all(color in colors for _, color in used):
+        # every color is in the global color table already
+        return {"im": part.quantize(palette=palette, dither=0), "include_color_table": False}
+    return {"im": part.convert("P", palette=Image.ADAPTIVE), "include_color_table": True}
+
+
+def get_image_from_url(url: str, session=None):
     """
     Basically the same as make_cover_from_url()
     @param url: The url of the image
+    @param session: The requests session to download it with, if not default_session()
     @return: A tuple of the image data, the image format and the image mime type
     """
+    return convert_image(*fetch_image(url, session))
+
+
+def fetch_image(url: str, session=None):
+    """
+    The downloading half of get_image_from_url(), which can run on any thread
+    @param url: The url of the image
+    @param session: The requests session to download it with, if not default_session()
+    @return: A tuple of the image's bytes (None if it couldn't be downloaded) and its format, if the url says what it is
+    """
     try:
         if url.startswith("https://www.filepicker.io/api/"):
             logger.warning("Filepicker.io image detected, converting to Fiction.live image. This might fail.")
             url = f"https://cdn3.fiction.live/fp/{url.split('/')[-1]}?&quality=95"
         elif url.startswith("https://cdn3.fiction.live/images/") or url.startswith("https://ddx5i92cqts4o.cloudfront.net/images/"):
-        	logger.warning("Converting url to cdn6. This might fail.")
-        	url = f"https://cdn6.fiction.live/file/fictionlive/images/{url.split('/images/')[-1]}"
+            logger.warning("Converting url to cdn6. This might fail.")
+            url = f"https://cdn6.fiction.live/file/fictionlive/images/{url.split('/images/')[-1]}"
         elif url.startswith("data:image") and 'base64' in url:
             logger.info("Base64 image detected")
             head, base64data = url.split(',')
-            file_ext = head.split(';')[0].split('/')[1]
-            imgdata = b64decode(base64data)
-            compressed_base64_image = compress_image(BytesIO(imgdata))
-            image_bytes = PIL_Image_to_bytes(compressed_base64_image, file_ext, imgdata)
-            if file_ext.lower() not in ["jpg", "jpeg", "gif"]:
-                return _convert_to_jpg(image_bytes).read(), "jpeg", "image/jpeg"
-            if file_ext.lower() == "jpg":
-                file_ext = "jpeg"
-            return image_bytes, file_ext, f"image/{file_ext}"
-
-        print(url)
-        img = requests.Session().get(url)
-        image = BytesIO(img.content)
-        image.seek(0)
+            return b64decode(base64data), head.split(';')[0].split('/')[1]
+
+        for retries in range(RETRIES + 1):
+            slept = rate_limiter.acquire(url)
+            start = time.perf_counter()
+            with host_slot(url), metrics.stage('fetch'):
+                img = (session or default_session()).get(url, timeout=TIMEOUT)
+            metrics.record(url, img, time.perf_counter() - start, kind='image', retries=retries, slept=slept)
+            if img.status_code not in RETRY_STATUSES or retries == RETRIES:
+                break
+            # as Site._soup does, the whole host waits
+            delay = _retry_after(img) or 2 ** (retries + 1)
+            logger.warning("Image load failed: waiting %s to retry (%s: %s)", delay, img.status_code, url)
+            rate_limiter.defer(url, delay)
+        if not img.ok:
+            # an error page, which is no use as an image, and mustn't be taken for one
+            logger.info(f"Couldn't download image ({img.status_code}): {url}")
+            return None, None
+        return img.content, None
 
+    except Exception as e:
+        logger.info("Encountered an error downloading image: " + str(e))
+        return None, None
+
+
+def _retry_after(response):
+    try:
+        return int(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        # missing, or a date, which isn't worth working out
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def default_session():
+    """
+    A session shared by everything which downloads images without being given one,
+    so that its connections are kept open between them
+    """
+    from sites.session import pooled_adapter
+    session = requests.Session()
+    adapter = pooled_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def convert_image(data, file_ext=None, gif_limits=GifLimits(), placeholder=True):
+    """
+    The CPU-bound half of get_image_from_url(), which can go to another process
+    @param data: The image's bytes, as fetch_image() returned them
+    @param file_ext: The image's format, if its url said; what the image itself says is what's gone by
+    @param gif_limits: How much of an animated GIF to keep
+    @param placeholder: Whether to make a placeholder image if it can't be converted, rather than returning None
+    @return: A tuple of the image data, the image format and the image mime type
+    """
+    try:
+        if data is None:
+            raise ValueError("Nothing was downloaded")
+
+        image = BytesIO(data)
+        # Only the header is read, which says what sort of image it is and how big
         PIL_image = Image.open(image)
-        if PIL_image.format.lower() == "gif":
-            PIL_image = Image.open(image)
-            if PIL_image.info['version'] not in [b"GIF89a", "GIF89a"]:
-                PIL_image.info['version'] = b"GIF89a"
-            return PIL_Image_to_bytes(PIL_image, "GIF", image.getvalue(), True), "gif", "image/gif"
+        if PIL_image.format == "GIF":
+            return PIL_Image_to_bytes(PIL_image, "GIF", data, True, gif_limits), "gif", "image/gif"
+
+        within_budget = len(data) <= target_length(len(data)) or not target_size(PIL_image.size, len(data))
+        if PIL_image.format == "JPEG" and PIL_image.mode in ("RGB", "L") and within_budget:
+            # Saving it again would only lose quality, and likely not save any space
+            logger.info(f"Image is small enough already, keeping it as it is ({get_size_format(len(data))})")
+            return data, "jpeg", "image/jpeg"
 
         sml_photo = compress_image(image)
 
@@ -150,19 +299,12 @@ def get_image_from_url(url: str):
 
     except Exception as e:
         logger.info("Encountered an error downloading image: " + str(e))
+        if not placeholder:
+            return None
         image = make_image("There was a problem downloading this image.")
         return image.read(), "jpeg", "image/jpeg"
 
 
-def _convert_to_jpg(image_bytestream) -> BytesIO:
-    png_image = BytesIO()
-    Image.open(image_bytestream).save(png_image, format="JPEG")
-    png_image.name = 'cover.jpeg'
-    png_image.seek(0)
-
-    return png_image
-
-
 def _safe_font(preferred, *args, **kwargs):
     for font in (preferred, "Helvetica", "FreeSans", "Arial"):
         try:
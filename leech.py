@@ -1,24 +1,45 @@
 #!/usr/bin/env python3
 
 import click
-import http.cookiejar
+import collections
+import datetime
+import functools
 import json
 import logging
 import os
-import requests
-import requests_cache
 import sqlite3
+import sys
+import time
 from click_default_group import DefaultGroup
 from functools import reduce
 
+# Only what every command needs is imported up here; ebook, requests and
+# requests_cache (and the sites themselves) are imported when they're used,
+# so that --help and the like start quickly
 import sites
-import ebook
+from sites.cache import CachePolicy
+from sites.metrics import metrics
+from sites.store import ChapterStore, ImageCache, DEFAULT_FILENAME as CHAPTER_STORE_FILENAME, IMAGE_CACHE_FILENAME
 
 __version__ = 2
 USER_AGENT = 'Leech/%s +http://davidlynch.org' % __version__
 
 logger = logging.getLogger(__name__)
 
+# Checked after any cache_policies from leech.json and the sites' own
+DEFAULT_CACHE_POLICIES = (
+    # images don't change, so keep them forever
+    CachePolicy(r'\.(?:jpe?g|png|gif|webp)(?:\?|$)', None),
+)
+
+DownloadResult = collections.namedtuple('DownloadResult', 'url, filename, seconds, error')
+
+# How many stories --async downloads at once
+THREADS = 4
+
+# Each --jobs worker process builds its own session, kept here
+_worker_session = None
+
 
 def configure_logging(verbose):
     if verbose:
@@ -33,11 +54,27 @@ def configure_logging(verbose):
         )
 
 
+def load_cache_policies():
+    try:
+        with open('leech.json') as store_file:
+            configured = json.load(store_file).get('cache_policies', [])
+    except FileNotFoundError:
+        configured = []
+    return CachePolicy.from_json(configured) + list(DEFAULT_CACHE_POLICIES)
+
+
 def create_session(cache):
+    import http.cookiejar
+    import requests
+    from sites.session import RevalidatingSession, pooled_adapter
+
     if cache:
-        session = requests_cache.CachedSession('leech', expire_after=4 * 3600)
+        session = RevalidatingSession('leech', expire_after=4 * 3600, cache_policies=load_cache_policies())
     else:
         session = requests.Session()
+    adapter = pooled_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
     lwp_cookiejar = http.cookiejar.LWPCookieJar()
     try:
@@ -61,14 +98,18 @@ def load_on_disk_options(site):
             configured_site_options = store.get('site_options', {}).get(site.site_key(), {})
             cover_options = store.get('cover', {})
             output_dir = store.get('output_dir', False)
+            parser = store.get('parser', False)
     except FileNotFoundError:
         logger.info("Unable to locate leech.json. Continuing assuming it does not exist.")
         login = False
         configured_site_options = {}
         cover_options = {}
         output_dir = False
+        parser = False
     if output_dir and 'output_dir' not in configured_site_options:
         configured_site_options['output_dir'] = output_dir
+    if parser and 'parser' not in configured_site_options:
+        configured_site_options['parser'] = parser
     return configured_site_options, login, cover_options
 
 
@@ -96,11 +137,26 @@ def create_options(site, site_options, unused_flags):
     return options, login
 
 
-def open_story(site, url, session, login, options):
+def open_chapter_store(enabled, days=None):
+    """The ChapterStore, if --chapter-store was given, keeping chapters for --chapter-store-days"""
+    if not enabled:
+        return None
+    return ChapterStore(max_age=datetime.timedelta(days=days) if days else None)
+
+
+def open_story(site, url, session, login, options, existing=None, chapter_store=None, chapter_sink=None):
     handler = site(
         session,
         options=options
     )
+    handler.chapter_sink = chapter_sink
+    if chapter_store:
+        handler.chapter_store = chapter_store.story(site.site_key(), url)
+    if existing:
+        # Only the chapters which aren't already in the ebook need to be fetched
+        handler.skip_chapters = len(existing.chapter_paths)
+        handler.skip_urls = existing.chapter_urls
+        handler.footnotes = existing.footnotes(options.get('parser'))
 
     if login:
         handler.login(login)
@@ -115,6 +171,119 @@ def open_story(site, url, session, login, options):
     return story
 
 
+def download_story(url, session, site_options, normalize, output_dir, other_flags, chapter_store=None, image_cache=None, gif_limits=None):
+    """Downloads a single story and writes it out as an epub, returning the filename."""
+    import ebook
+
+    site, url = sites.get(url)
+    options, login = create_options(site, site_options, other_flags)
+    # Chapters are rendered and written into the epub while the rest are still being fetched
+    epub = ebook.StreamingEpub(
+        output_dir=output_dir or options.get('output_dir', os.getcwd()),
+        normalize=normalize,
+        parser=options.get('parser'),
+        image_cache=image_cache,
+        # so images and the cover share its connections, cache, cookies and user agent
+        session=session,
+        gif_limits=gif_limits
+    )
+    try:
+        story = open_story(site, url, session, login, options, chapter_store=chapter_store, chapter_sink=epub.add_chapter)
+    except BaseException:
+        epub.abort()
+        raise
+    if not story:
+        epub.abort()
+        logger.warning("No ebook created")
+        return
+    try:
+        filename = epub.finish(story, options)
+    except BaseException:
+        epub.abort()
+        raise
+    logger.info("File created: " + filename)
+    return filename
+
+
+def timed_download(url, session, *args):
+    """Runs download_story, logging rather than raising any failure, and reports how it went."""
+    start = time.monotonic()
+    filename, error = None, None
+    try:
+        filename = download_story(url, session, *args)
+    except Exception as e:
+        logger.exception("Couldn't download %s", url)
+        error = str(e) or e.__class__.__name__
+    return DownloadResult(url, filename, time.monotonic() - start, error)
+
+
+def download_stories_in_threads(urls, session, *args):
+    """Downloads THREADS stories at a time, on a pool of threads sharing one session.
+
+    It's a plain thread pool: fetching, parsing and images all block. Every
+    request waits on its host's slots (sites.host_slot) and rate limit, so
+    stories from the same site don't hit it any harder than a single story
+    with more concurrency would.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        return list(executor.map(lambda url: timed_download(url, session, *args), urls))
+
+
+def download_stories_in_processes(urls, jobs, cache, verbose, spill_over, *args):
+    """Downloads stories in parallel worker processes, each with its own session.
+
+    Parsing and image handling are CPU-bound, so this scales where threads
+    wouldn't. The workers share the on-disk cache.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_download_worker, initargs=(cache, verbose, spill_over)) as executor:
+        for result, measured in executor.map(functools.partial(_download_in_worker, args=args), urls):
+            # so the summary covers every worker's requests
+            metrics.merge(measured)
+            results.append(result)
+    return results
+
+
+def _init_download_worker(cache, verbose, spill_over):
+    global _worker_session
+    configure_logging(verbose)
+    if spill_over:
+        sites.spill.configure(spill_over * 1024)
+    _worker_session = create_session(cache)
+
+
+def _download_in_worker(url, args):
+    return timed_download(url, _worker_session, *args), metrics.drain()
+
+
+def print_summary(results):
+    url_width = max(len(result.url) for result in results)
+    click.echo()
+    click.echo(f"{'Status':<8} {'Time':>8}  {'URL':<{url_width}}  Result")
+    for result in results:
+        if result.filename:
+            status, outcome = 'ok', result.filename
+        elif result.error:
+            status, outcome = 'FAILED', result.error
+        else:
+            status, outcome = 'empty', "No ebook created"
+        click.echo(f"{status:<8} {result.seconds:>7.1f}s  {result.url:<{url_width}}  {outcome}")
+    created = sum(1 for result in results if result.filename)
+    click.echo(f"{created} of {len(results)} ebooks created in {sum(result.seconds for result in results):.1f}s of work")
+
+
+def print_metrics():
+    lines = metrics.summary()
+    if lines:
+        click.echo()
+        for line in lines:
+            click.echo(line)
+
+
 def site_specific_options(f):
     option_list = sites.list_site_specific_options()
     return reduce(lambda cmd, decorator: decorator(cmd), [f] + option_list)
@@ -130,6 +299,8 @@ def cli():
 @click.option('--verbose', '-v', is_flag=True, help="verbose output")
 def flush(verbose):
     """Flushes the contents of the cache."""
+    import requests_cache
+
     configure_logging(verbose)
     requests_cache.install_cache('leech')
     requests_cache.clear()
@@ -138,11 +309,21 @@ def flush(verbose):
     conn.execute("VACUUM")
     conn.close()
 
+    if os.path.exists(CHAPTER_STORE_FILENAME):
+        ChapterStore().clear()
+    if os.path.exists(IMAGE_CACHE_FILENAME):
+        ImageCache().clear()
+
     logger.info("Flushed cache")
 
 
 @cli.command()
-@click.argument('urls', nargs=-1, required=True)
+@click.argument('urls', nargs=-1)
+@click.option(
+    '--from-file',
+    type=click.File('r'),
+    help='File listing URLs to download, one per line. Blank lines and lines starting with # are ignored.'
+)
 @click.option(
     '--site-options',
     default='{}',
@@ -154,27 +335,163 @@ def flush(verbose):
     help='Directory to save generated ebooks'
 )
 @click.option('--cache/--no-cache', default=True)
+@click.option(
+    '--chapter-store/--no-chapter-store',
+    default=False,
+    help="Keep processed chapters on disk, and reuse them rather than fetching and cleaning them again"
+)
+@click.option(
+    '--chapter-store-days',
+    type=float,
+    help="Fetch stored chapters again once they're this many days old (by default they're kept until flushed)"
+)
 @click.option('--normalize/--no-normalize', default=True, help="Whether to normalize strange unicode text")
 @click.option('--verbose', '-v', is_flag=True, help="Verbose debugging output")
+@click.option('--async', 'use_async', is_flag=True, help="Download several stories at once, on a few threads, rather than one after another")
+@click.option('--jobs', '-j', type=int, default=1, help="Download this many stories at once, in separate processes")
+@click.option(
+    '--metrics',
+    'metrics_file',
+    type=click.File('w'),
+    help="File to write every request and stage timing to, as JSON lines"
+)
+@click.option('--profile', 'profile_file', type=click.Path(dir_okay=False, writable=True), help="Profile the download, writing the results to this file")
+@click.option(
+    '--profile-mode',
+    type=click.Choice(('cprofile', 'sample')),
+    default='cprofile',
+    help="cprofile: every function call, as pstats data. sample: cheaper, as collapsed stacks for flame graphs."
+)
+@click.option(
+    '--spill-over',
+    type=int,
+    help="Keep chapter text and images bigger than this many KB in a temporary file, rather than in memory"
+)
+@click.option('--gif-frames', type=int, help="Keep at most this many frames of animated GIFs (1 for a still of the first)")
+@click.option('--gif-seconds', type=float, help="Keep at most this many seconds of animated GIFs")
 @site_specific_options  # Includes other click.options specific to sites
-def download(urls, site_options, cache, verbose, normalize, output_dir, **other_flags):
+def download(
+    urls, from_file, site_options, cache, chapter_store, chapter_store_days, verbose, normalize, output_dir, use_async, jobs, metrics_file,
+    profile_file, profile_mode, spill_over, gif_frames, gif_seconds, **other_flags
+):
     """Downloads a story and saves it on disk as an epub ebook."""
+    from ebook import GifLimits
+
+    configure_logging(verbose)
+
+    urls = list(urls)
+    if from_file:
+        urls.extend(line.strip() for line in from_file if line.strip() and not line.lstrip().startswith('#'))
+    if not urls:
+        raise click.UsageError("No URLs given")
+    if use_async and jobs > 1:
+        raise click.UsageError("--async and --jobs can't be used together")
+    if profile_file and jobs > 1:
+        raise click.UsageError("--profile only sees this process, so can't be used with --jobs")
+    if spill_over:
+        sites.spill.configure(spill_over * 1024)
+
+    if profile_file:
+        from sites.profiling import profiler
+        profile = profiler(profile_mode)
+        profile.start()
+
+    args = (
+        site_options, normalize, output_dir, other_flags,
+        open_chapter_store(chapter_store, chapter_store_days),
+        # compressed images go along with the rest of the cache
+        cache and ImageCache() or None,
+        GifLimits(gif_frames, gif_seconds),
+    )
+    if jobs > 1:
+        results = download_stories_in_processes(urls, jobs, cache, verbose, spill_over, *args)
+    elif use_async:
+        results = download_stories_in_threads(urls, create_session(cache), *args)
+    else:
+        session = create_session(cache)
+        results = [timed_download(url, session, *args) for url in urls]
+
+    if profile_file:
+        profile.stop()
+        profile.write(profile_file)
+
+    if len(results) > 1:
+        print_summary(results)
+    print_metrics()
+    if profile_file:
+        click.echo()
+        for line in profile.summary():
+            click.echo(line)
+        click.echo(f"Profile written to {profile_file}")
+    if metrics_file:
+        metrics.write_jsonl(metrics_file)
+    if any(result.error for result in results):
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('filenames', nargs=-1, required=True)
+@click.option(
+    '--site-options',
+    default='{}',
+    help='JSON object encoding any site specific option.'
+)
+@click.option('--cache/--no-cache', default=True)
+@click.option(
+    '--chapter-store/--no-chapter-store',
+    default=False,
+    help="Keep processed chapters on disk, and reuse them rather than fetching and cleaning them again"
+)
+@click.option(
+    '--chapter-store-days',
+    type=float,
+    help="Fetch stored chapters again once they're this many days old (by default they're kept until flushed)"
+)
+@click.option('--normalize/--no-normalize', default=True, help="Whether to normalize strange unicode text")
+@click.option('--verbose', '-v', is_flag=True, help="Verbose debugging output")
+@click.option('--gif-frames', type=int, help="Keep at most this many frames of animated GIFs (1 for a still of the first)")
+@click.option('--gif-seconds', type=float, help="Keep at most this many seconds of animated GIFs")
+@site_specific_options  # Includes other click.options specific to sites
+def update(filenames, site_options, cache, chapter_store, chapter_store_days, normalize, verbose, gif_frames, gif_seconds, **other_flags):
+    """Adds any new chapters to epub ebooks made by an earlier download."""
+    import ebook
+
     configure_logging(verbose)
     session = create_session(cache)
+    chapter_store = open_chapter_store(chapter_store, chapter_store_days)
+    image_cache = cache and ImageCache() or None
 
-    for url in urls:
-        site, url = sites.get(url)
+    for filename in filenames:
+        existing = ebook.read_existing_epub(filename)
+        site, url = sites.get(existing.url)
         options, login = create_options(site, site_options, other_flags)
-        story = open_story(site, url, session, login, options)
-        if story:
-            filename = ebook.generate_epub(
-                story, options,
-                normalize=normalize,
-                output_dir=output_dir or options.get('output_dir', os.getcwd())
+        story = open_story(site, url, session, login, options, existing=existing, chapter_store=chapter_store)
+        if not story:
+            logger.warning("Couldn't update %s", filename)
+            continue
+        if any(hasattr(chapter, '__iter__') for chapter in story):
+            logger.error("Can't update %s, as it's made of several stories; download it again instead", filename)
+            continue
+        gif_limits = ebook.GifLimits(gif_frames, gif_seconds)
+        added = ebook.update_epub(
+            story, existing, normalize=normalize, parser=options.get('parser'),
+            image_cache=image_cache, session=session, gif_limits=gif_limits
+        )
+        if added is None:
+            logger.info("The chapters of %s have changed since it was made, so making it again", filename)
+            if any(chapter.contents is None for chapter in story):
+                # the site skipped the ebook's chapters without being able to check them
+                story = open_story(site, url, session, login, options, chapter_store=chapter_store)
+                if not story:
+                    logger.warning("Couldn't update %s", filename)
+                    continue
+            chapters = ebook.rebuild_epub(
+                story, existing, options, normalize=normalize, parser=options.get('parser'),
+                image_cache=image_cache, session=session, gif_limits=gif_limits
             )
-            logger.info("File created: " + filename)
-        else:
-            logger.warning("No ebook created")
+            logger.info("Made %s again, with %d chapters", filename, chapters)
+            continue
+        logger.info("Added %d new chapters to %s", added, filename)
 
 
 if __name__ == '__main__':
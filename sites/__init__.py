@@ -1,19 +1,48 @@
 
 import click
+import collections
+import contextlib
 import glob
+import itertools
 import os
 import random
+import threading
 import uuid
 import time
 import logging
 import urllib
 import re
 import attr
-from bs4 import BeautifulSoup
+import functools
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+from .cache import CachePolicy
+from .metrics import metrics
+from .spill import spill
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 _sites = []
+# hostname -> the registered site classes which handle URLs there, in registration order
+_sites_by_host = collections.defaultdict(list)
+# site classes which don't say what hosts they handle, so have to be asked about every URL
+_sites_any_host = []
+# site modules imported so far, with '*' once they all have been
+_imported = set()
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+# Requests in flight to any one host at once, from everything in this process,
+# unless a site's concurrency option asks for more
+PER_HOST = 4
+
+
+# BeautifulSoup tree builders a site can be parsed with; lxml is much faster than html5lib, if it's installed
+PARSERS = ('lxml', 'html5lib', 'html.parser')
+# Every site's cleanup was written against html5lib's trees, and the others
+# build different ones from broken markup, so they have to be asked for
+DEFAULT_PARSER = 'html5lib'
+# Shared, so that list_site_specific_options sees every site's --parser as the same option
+_parser_choice = click.Choice(PARSERS)
 
 
 def _default_uuid_string(self):
@@ -21,22 +50,43 @@ def _default_uuid_string(self):
     return str(uuid.UUID(int=rd.getrandbits(8*16), version=4))
 
 
-@attr.s
+@attr.s(slots=True)
 class Image:
     path = attr.ib()
-    contents = attr.ib()
+    # may be out in the spill file; see contents
+    _contents = attr.ib(converter=spill.store)
     content_type = attr.ib()
 
+    @property
+    def contents(self):
+        return spill.load(self._contents)
 
-@attr.s
+    @contents.setter
+    def contents(self, value):
+        self._contents = spill.store(value)
+
+
+@attr.s(slots=True)
 class Chapter:
     title = attr.ib()
-    contents = attr.ib()
+    # may be out in the spill file; see contents
+    _contents = attr.ib(converter=spill.store)
     date = attr.ib(default=False)
     images = attr.ib(default=attr.Factory(list))
+    # Where it came from, if the site knows; an updated ebook is checked against it
+    url = attr.ib(default=None)
 
+    @property
+    def contents(self):
+        """The chapter's HTML, or None for a placeholder; read back in from the spill file if need be (see sites.spill)"""
+        return spill.load(self._contents)
 
-@attr.s
+    @contents.setter
+    def contents(self, value):
+        self._contents = spill.store(value)
+
+
+@attr.s(slots=True)
 class Section:
     title = attr.ib()
     author = attr.ib()
@@ -85,6 +135,29 @@ class Site:
         lambda site: site.get_default_options(),
         True
     ))
+    # When updating an existing ebook: how many chapters it already has, which won't be fetched again
+    skip_chapters = attr.ib(default=0, init=False)
+    # ...and their URLs, where the ebook has them, to check they're still the story's first chapters
+    skip_urls = attr.ib(factory=list, init=False)
+    # A StoredStory (from sites.store) to reuse processed chapters from, if any
+    chapter_store = attr.ib(default=None, init=False)
+    # Called with each chapter as soon as it's extracted, before the whole story is done, if set
+    chapter_sink = attr.ib(default=None, init=False)
+
+    # Options which only affect how things are fetched, not what the chapters end up containing
+    fetch_options = ('concurrency', 'rate_limit', 'rate_burst')
+
+    # The parts of a chapter page (a sites.regions.PageRegions) which _chapters needs parsed, if not all of it;
+    # only lxml and html.parser can skip the rest, so with the default html5lib this changes nothing
+    chapter_regions = None
+
+    # How long pages from this site stay fresh in the cache, by URL (see sites.cache.CachePolicy).
+    # A `cache_policies` entry in the site's options is checked before these.
+    cache_policies = ()
+
+    # The hostnames this site's URLs can be on; subdomains of these are included. If empty, every
+    # URL is checked against `matches`.
+    hosts = ()
 
     @classmethod
     def site_key(cls):
@@ -109,6 +182,39 @@ class Site:
                 default=True,
                 help="If true, colors will be stripped from the text."
             ),
+            SiteSpecificOption(
+                'prettify',
+                '--prettify/--no-prettify',
+                default=False,
+                help="If true, chapter HTML will be indented to be easier to read, at the cost of a bigger, slower ebook."
+            ),
+            SiteSpecificOption(
+                'parser',
+                '--parser',
+                type=_parser_choice,
+                default=DEFAULT_PARSER,
+                help="Which HTML parser to use. lxml is fastest, html5lib is closest to how a browser would see the page."
+            ),
+            SiteSpecificOption(
+                'concurrency',
+                '--concurrency',
+                type=int,
+                default=1,
+                help="How many chapters to fetch at once, for sites which support it."
+            ),
+            SiteSpecificOption(
+                'rate_limit',
+                '--rate-limit',
+                type=float,
+                help="Most requests per second to make to this site's hosts. Unlimited if not given."
+            ),
+            SiteSpecificOption(
+                'rate_burst',
+                '--rate-burst',
+                type=int,
+                default=1,
+                help="How many requests can be made back-to-back before --rate-limit applies."
+            ),
         ]
 
     @classmethod
@@ -132,6 +238,10 @@ class Site:
                 options[option.name] = option_value
         return options
 
+    @classmethod
+    def get_hosts(cls):
+        return cls.hosts
+
     @staticmethod
     def matches(url):
         raise NotImplementedError()
@@ -152,8 +262,42 @@ class Site:
     def login(self, login_details):
         raise NotImplementedError()
 
-    def _soup(self, url, method='html5lib', delay=0, retry=3, retry_delay=10, **kw):
-        page = self.session.get(url, **kw)
+    def _throttle(self, url):
+        """Wait for this site's turn to make a request to `url`"""
+        return rate_limiter.acquire(url, rate=self.options.get('rate_limit'), burst=self.options.get('rate_burst'))
+
+    def _get(self, url, retries=0, **kw):
+        """Like session.get, but waits its turn with the shared per-host rate
+        limiter, and for one of the host's slots (see host_slot)
+
+        The request is recorded in sites.metrics; `retries` is how many times
+        fetching it has already failed. Pages the cache can answer without
+        asking the host don't wait at all.
+        """
+        if getattr(self.session, 'cache_policies', None) is not None:
+            kw.setdefault('cache_policies', self._cache_policies())
+        is_fresh = getattr(self.session, 'is_fresh', None)
+        throttled = not (is_fresh and is_fresh(url, **kw))
+        slept = self._throttle(url) if throttled else 0
+        slot = host_slot(url, max(self.options.get('concurrency') or 1, PER_HOST)) if throttled else contextlib.nullcontext()
+        start = time.perf_counter()
+        with slot, metrics.stage('fetch'):
+            page = self.session.get(url, **kw)
+        metrics.record(url, page, time.perf_counter() - start, retries=retries, slept=slept)
+        if throttled and getattr(page, 'from_cache', False) and not getattr(page, 'revalidated', False):
+            # never actually hit the host, so it shouldn't count against it
+            rate_limiter.refund(url)
+        return page
+
+    def _cache_policies(self):
+        configured = self.options.get('cache_policies')
+        return (CachePolicy.from_json(configured) if configured else []) + list(self.cache_policies)
+
+    def _parser(self):
+        return self.options.get('parser') or DEFAULT_PARSER
+
+    def _soup(self, url, method=None, delay=0, retry=3, retry_delay=10, parse_only=None, retries=0, **kw):
+        page = self._get(url, retries=retries, **kw)
         if not page:
             if page.status_code == 403 and page.headers.get('Server', False) == 'cloudflare' and "captcha-bypass" in page.text:
                 raise CloudflareException("Couldn't fetch, probably because of Cloudflare protection", url)
@@ -162,12 +306,95 @@ class Site:
                 if 'Retry-After' in page.headers:
                     real_delay = int(page.headers['Retry-After'])
                 logger.warning("Load failed: waiting %s to retry (%s: %s)", real_delay, page.status_code, page.url)
-                time.sleep(real_delay)
-                return self._soup(url, method=method, retry=retry - 1, retry_delay=retry_delay, **kw)
+                rate_limiter.defer(url, real_delay)
+                return self._soup(
+                    url, method=method, delay=delay, retry=retry - 1, retry_delay=retry_delay, parse_only=parse_only, retries=retries + 1, **kw
+                )
             raise SiteException("Couldn't fetch", url)
-        if delay and delay > 0 and not page.from_cache:
-            time.sleep(delay)
-        return BeautifulSoup(page.text, method)
+        # a revalidated (304) page is from the cache too, and cheap enough for the host not to need a delay
+        if delay and delay > 0 and not getattr(page, 'from_cache', False):
+            rate_limiter.defer(url, delay)
+        method = method or self._parser()
+        if method == 'html5lib':
+            # html5lib always parses the whole page, and would only warn about it
+            parse_only = None
+        from bs4 import BeautifulSoup
+        with metrics.stage('parse'):
+            return BeautifulSoup(page.text, method, parse_only=parse_only)
+
+    def _chapters(self, urls, process, fetch=None):
+        """Fetch a list of chapter URLs and yield a Chapter built from each, in story order.
+
+        `fetch` (default: `self._soup`) may run for several URLs at once, as
+        allowed by the `concurrency` option. `process(url, page)` is always
+        called on this thread, one chapter at a time and in order, so footnote
+        numbering and the like come out just as they would sequentially. If it
+        returns None, that chapter is skipped.
+
+        The first `skip_chapters` chapters aren't fetched at all, and come back
+        as placeholders with no contents, unless they aren't the `skip_urls`
+        any more; then every chapter is fetched. Every chapter's `url` is set. If there's a `chapter_store`, chapters
+        already in it are used as-is, and new ones are added to it. Every other
+        chapter is handed to `chapter_sink` (if any) as it's yielded.
+        """
+        skip = self._chapters_to_skip(urls)
+        for url in urls[:skip]:
+            yield Chapter(title=None, contents=None, url=url)
+        urls = urls[skip:]
+        fetch = functools.partial(_fetch_chapter, fetch or functools.partial(self._soup, parse_only=self.chapter_regions))
+
+        options_key = self._content_options_key()
+        stored = self.chapter_store.load(urls, options_key) if self.chapter_store else {}
+
+        scheduler = FetchScheduler(workers=self.options.get('concurrency') or 1)
+        pages = scheduler.map(fetch, [url for url in urls if url not in stored])
+        for chapterid, url in enumerate(urls, skip + 1):
+            if url in stored:
+                chapter = self._restore_chapter(stored[url], chapterid)
+                if chapter:
+                    chapter.url = url
+                    yield self._sink(chapter)
+                    continue
+                # its footnotes don't fit where it is now, so start over
+                page = fetch(url)
+            else:
+                page = next(pages)
+            footnote_start = len(self.footnotes) + 1
+            with metrics.stage('clean'):
+                chapter = process(url, page)
+            if chapter is None:
+                continue
+            chapter.url = chapter.url or url
+            if self.chapter_store:
+                self.chapter_store.save(url, options_key, chapter, chapterid, footnote_start, self.footnotes[footnote_start - 1:])
+            yield self._sink(chapter)
+
+    def _chapters_to_skip(self, urls):
+        """How many of `urls` are already in the ebook being updated, so needn't be fetched"""
+        if len(urls) < self.skip_chapters or any(
+            known and known != url for known, url in zip(self.skip_urls[:self.skip_chapters], urls)
+        ):
+            logger.info("The ebook's chapters aren't the story's first chapters any more, so fetching them all")
+            # the ebook's footnotes go with its chapters
+            del self.footnotes[:]
+            return 0
+        return self.skip_chapters
+
+    def _sink(self, chapter):
+        if self.chapter_sink:
+            self.chapter_sink(chapter)
+        return chapter
+
+    def _restore_chapter(self, stored, chapterid):
+        """Returns a stored chapter, registering its footnotes, if they'll still be numbered the same"""
+        if stored.footnotes:
+            if stored.footnote_start != len(self.footnotes) + 1 or stored.chapterid != chapterid:
+                return
+            self.footnotes.extend(stored.footnotes)
+        return stored.chapter
+
+    def _content_options_key(self):
+        return sorted((k, v) for k, v in self.options.items() if k in self.get_default_options() and k not in self.fetch_options)
 
     def _form_in_soup(self, soup):
         if soup.name == 'form':
@@ -207,9 +434,16 @@ class Site:
         return data, form.attrs.get('action'), form.attrs.get('method', 'get').lower()
 
     def _new_tag(self, *args, **kw):
-        soup = BeautifulSoup("", 'html5lib')
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup("", self._parser())
         return soup.new_tag(*args, **kw)
 
+    def _serialize(self, tag):
+        """Turns cleaned-up chapter HTML back into a string, compactly unless the `prettify` option is set"""
+        if self.options.get('prettify'):
+            return tag.prettify()
+        return str(tag)
+
     def _join_url(self, *args, **kwargs):
         return urllib.parse.urljoin(*args, **kwargs)
 
@@ -234,7 +468,7 @@ class Site:
         backlink.string = '^'
         contents.insert(0, backlink)
 
-        self.footnotes.append(contents.prettify())
+        self.footnotes.append(self._serialize(contents))
 
         # now build the link to the footnote to return, with appropriate
         # epub annotations.
@@ -264,8 +498,8 @@ class Site:
             a.decompose()
         # strip colors
         if self.options['strip_colors']:
-            for tag in contents.find_all(style=re.compile(r'(?:color|background)\s*:')):
-                tag['style'] = re.sub(r'(?:color|background)\s*:[^;]+;?', '', tag['style'])
+            for tag in contents.find_all(style=_color_style):
+                tag['style'] = _color_declaration.sub('', tag['style'])
 
         return contents
 
@@ -296,6 +530,167 @@ class SiteSpecificOption:
         )
 
 
+@attr.s
+class FetchScheduler:
+    """Runs fetches on a bounded pool of worker threads.
+
+    Results come back in the order the URLs were given, however the fetches
+    actually finish. How many requests are in flight against any one host is
+    up to host_slot, which every request made through Site._get waits on.
+    """
+    workers = attr.ib(default=1)
+
+    def map(self, fetch, urls):
+        if self.workers <= 1:
+            for url in urls:
+                yield fetch(url)
+            return
+        urls = iter(urls)
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                # Only run a little ahead of the consumer, so a slow consumer
+                # doesn't end up holding every fetched page in memory.
+                for url in itertools.islice(urls, self.workers * 2):
+                    pending.append(executor.submit(fetch, url))
+                while pending:
+                    result = pending.popleft().result()
+                    for url in itertools.islice(urls, 1):
+                        pending.append(executor.submit(fetch, url))
+                    yield result
+            finally:
+                for future in pending:
+                    future.cancel()
+
+
+@attr.s
+class RateLimiter:
+    """A token bucket per host, shared by everything that fetches in this process.
+
+    Each host earns `rate` tokens a second, up to `burst` saved up, and every
+    request spends one. Hosts with no rate configured are unlimited, but will
+    still honor `defer`, which is how Retry-After and fixed delays are applied.
+    """
+    _buckets = attr.ib(factory=dict, init=False)
+    _lock = attr.ib(factory=threading.Lock, init=False)
+
+    def acquire(self, url, rate=None, burst=None):
+        """Block until a request to `url`'s host is allowed. Returns the time spent waiting.
+
+        If `rate` is given, the host's bucket is (re)configured with it first.
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                bucket = self._bucket(url)
+                if rate is not None:
+                    bucket.configure(rate, burst)
+                wait = bucket.take(time.monotonic())
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def refund(self, url):
+        with self._lock:
+            self._bucket(url).refund()
+
+    def defer(self, url, seconds):
+        """Don't allow any more requests to `url`'s host for `seconds`"""
+        with self._lock:
+            self._bucket(url).defer(time.monotonic() + seconds)
+
+    def _bucket(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self._buckets:
+            self._buckets[host] = _TokenBucket()
+        return self._buckets[host]
+
+
+@attr.s
+class _TokenBucket:
+    rate = attr.ib(default=None)
+    burst = attr.ib(default=1)
+    tokens = attr.ib(default=1.0)
+    updated = attr.ib(factory=time.monotonic)
+    not_before = attr.ib(default=0)
+
+    def configure(self, rate, burst):
+        if self.rate is None:
+            # start out with a full bucket
+            self.tokens = max(burst or 1, 1)
+        self.rate = rate
+        self.burst = max(burst or 1, 1)
+
+    def take(self, now):
+        """Spend a token if one's available and return 0, otherwise return how long to wait for one"""
+        if now < self.not_before:
+            return self.not_before - now
+        if not self.rate:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def defer(self, until):
+        self.not_before = max(self.not_before, until)
+
+
+rate_limiter = RateLimiter()
+
+
+def _fetch_chapter(fetch, url):
+    with metrics.kind('chapter'):
+        return fetch(url)
+
+
+def host_slot(url, limit=PER_HOST):
+    """One of the slots for requests in flight to `url`'s host, to hold
+    (`with host_slot(url): ...`) while making one"""
+    host = urllib.parse.urlparse(url).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = HostSlots()
+        slots = _host_slots[host]
+    slots.allow(limit)
+    return slots
+
+
+@attr.s
+class HostSlots:
+    """How many fetches can be in flight against one host at once.
+
+    Everything fetching from the host shares one of these, so the limit only
+    ever goes up: to the largest any of them has asked for.
+    """
+    limit = attr.ib(default=1)
+    _in_use = attr.ib(default=0, init=False)
+    _condition = attr.ib(factory=threading.Condition, init=False, repr=False)
+
+    def allow(self, limit):
+        with self._condition:
+            if limit > self.limit:
+                self.limit = limit
+                self._condition.notify_all()
+
+    def __enter__(self):
+        with self._condition:
+            while self._in_use >= self.limit:
+                self._condition.wait()
+            self._in_use += 1
+
+    def __exit__(self, *exc):
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify()
+
+
 class SiteException(Exception):
     pass
 
@@ -304,18 +699,112 @@ class CloudflareException(SiteException):
     pass
 
 
+_color_style = re.compile(r'(?:color|background)\s*:')
+_color_declaration = re.compile(r'(?:color|background)\s*:[^;]+;?')
+_url_host = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://(?:[^/?#@]*@)?([^/?#:]+)')
+
+
+@functools.lru_cache(maxsize=None)
+def domain_pattern(template, domain):
+    """A compiled `template % domain`, for sites whose URL patterns depend on their domain"""
+    return re.compile(template % domain)
+
+
+@functools.lru_cache(maxsize=256)
+def selector(css):
+    """A compiled CSS selector, for ones used over and over (e.g. on every post)"""
+    import soupsieve
+    return soupsieve.compile(css)
+
+
 def register(site_class):
     _sites.append(site_class)
+    hosts = site_class.get_hosts()
+    for host in hosts:
+        _sites_by_host[host.lower()].append(site_class)
+    if not hosts:
+        _sites_any_host.append(site_class)
+    _candidates_for_host.cache_clear()
+    _check_manifest(site_class)
     return site_class
 
 
-def get(url):
-    for site_class in _sites:
+def _check_manifest(site_class):
+    module = site_class.__module__.rpartition('.')[2]
+    listed = next((entry for entry in manifest.MODULES if entry.name == module), None)
+    if listed and not set(site_class.get_hosts()) <= set(listed.hosts):
+        logger.warning("%s handles hosts which sites/manifest.py doesn't list for %s", site_class.__name__, module)
+
+
+def _candidates(url):
+    """The registered site classes which might handle url, in registration order"""
+    return _candidates_for_host(_host(url))
+
+
+def _host(url):
+    match = _url_host.match(url)
+    return match and match.group(1).lower()
+
+
+def _suffixes(host):
+    # www.royalroad.com, royalroad.com, com
+    parts = host.split('.')
+    return ('.'.join(parts[i:]) for i in range(len(parts)))
+
+
+@functools.lru_cache(maxsize=1024)
+def _candidates_for_host(host):
+    if not host:
+        return tuple(_sites_any_host)
+    candidates = set(_sites_any_host)
+    for suffix in _suffixes(host):
+        candidates.update(_sites_by_host.get(suffix, ()))
+    return tuple(site_class for site_class in _sites if site_class in candidates)
+
+
+@functools.lru_cache(maxsize=1024)
+def _modules_for_host(host):
+    hosts = set(_suffixes(host)) if host else set()
+    return tuple(entry for entry in manifest.MODULES if not entry.hosts or hosts.intersection(entry.hosts))
+
+
+def _import(module):
+    if module not in _imported:
+        importlib.import_module('.' + module, __name__)
+        _imported.add(module)
+
+
+def _import_all():
+    """Import every site module, including any which aren't in the manifest"""
+    if '*' in _imported:
+        return
+    for module in glob.glob(os.path.join(os.path.dirname(__file__), "*.py")):
+        module = os.path.basename(module)[:-3]
+        if not module.startswith('_'):
+            _import(module)
+    _imported.add('*')
+
+
+def _find(url):
+    for site_class in _candidates(url):
         match = site_class.matches(url)
         if match:
             logger.info("Handler: %s (%s)", site_class, match)
             return site_class, match
-    raise NotImplementedError("Could not find a handler for " + url)
+
+
+def get(url):
+    for entry in _modules_for_host(_host(url)):
+        if entry.name not in _imported and entry.wants(url):
+            _import(entry.name)
+    found = _find(url)
+    if not found:
+        # maybe a site the manifest doesn't know about
+        _import_all()
+        found = _find(url)
+    if not found:
+        raise NotImplementedError("Could not find a handler for " + url)
+    return found
 
 
 def list_site_specific_options():
@@ -323,18 +812,15 @@ def list_site_specific_options():
 
     # Ensures that duplicate options are not added twice.
     # Especially important for subclassed sites (e.g. Xenforo sites)
-    options = set()
+    options = set(Site.get_site_specific_option_defs())
 
+    # The sites themselves aren't imported yet, so their options come from the manifest
+    for entry in manifest.MODULES:
+        options.update(entry.options)
     for site_class in _sites:
         options.update(site_class.get_site_specific_option_defs())
     return [option.as_click_option() for option in options]
 
 
-# And now, a particularly hacky take on a plugin system:
-# Make an __all__ out of all the python files in this directory that don't start
-# with __. Then import * them.
-
-modules = glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))
-__all__ = [os.path.basename(f)[:-3] for f in modules if not f.startswith("__")]
-
-from . import *  # noqa
+# The site modules are imported as they're needed; see sites/manifest.py
+from . import manifest  # noqa: E402
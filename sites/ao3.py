@@ -6,6 +6,7 @@ import re
 import requests_cache
 from bs4 import BeautifulSoup
 from . import register, Site, Section, Chapter, SiteException
+from .regions import PageRegions
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +14,8 @@ logger = logging.getLogger(__name__)
 @register
 class ArchiveOfOurOwn(Site):
     """Archive of Our Own: it has its own epub export, but the formatting is awful"""
+    hosts = ('archiveofourown.org',)
+
     @staticmethod
     def matches(url):
         # e.g. http://archiveofourown.org/works/5683105/chapters/13092007
@@ -23,7 +26,7 @@ class ArchiveOfOurOwn(Site):
     def login(self, login_details):
         with requests_cache.disabled():
             login = self.session.get('https://archiveofourown.org/users/login')
-            soup = BeautifulSoup(login.text, 'html5lib')
+            soup = BeautifulSoup(login.text, self._parser())
             post, action, method = self._form_data(soup.find(id='new_user'))
             post['user[login]'] = login_details[0]
             post['user[password]'] = login_details[1]
@@ -43,7 +46,8 @@ class ArchiveOfOurOwn(Site):
         # Fetch the full work
         url = f'http://archiveofourown.org/works/{workid}?view_adult=true&view_full_work=true'
         logger.info("Extracting full work @ %s", url)
-        soup = self._soup(url)
+        # the text, plus the tags from the work's metadata
+        soup = self._soup(url, parse_only=PageRegions(ids=('workskin',), classes=('meta',)))
 
         if not soup.find(id='workskin'):
             raise SiteException("Can't find the story text; you may need to log in or flush the cache")
@@ -51,13 +55,13 @@ class ArchiveOfOurOwn(Site):
         story = Section(
             title=soup.select('#workskin > .preface .title')[0].text.strip(),
             author=soup.select('#workskin .preface .byline a')[0].text.strip(),
-            summary=soup.select('#workskin .preface .summary blockquote')[0].prettify(),
+            summary=self._serialize(soup.select('#workskin .preface .summary blockquote')[0]),
             url=f'http://archiveofourown.org/works/{workid}',
             tags=[tag.get_text().strip() for tag in soup.select('.work.meta .tags a.tag')]
         )
 
         # Fetch the chapter list as well because it contains info that's not in the full work
-        nav_soup = self._soup(f'https://archiveofourown.org/works/{workid}/navigate')
+        nav_soup = self._soup(f'https://archiveofourown.org/works/{workid}/navigate', parse_only=PageRegions(ids=('main',)))
         chapters = soup.find_all(id=re.compile(r"chapter-\d+"))
 
         for index, chapter in enumerate(nav_soup.select('#main ol[role="navigation"] li')):
@@ -98,7 +102,7 @@ class ArchiveOfOurOwn(Site):
 
         self._clean(content)
 
-        return content.prettify() + (notes and notes.prettify() or '')
+        return self._serialize(content) + (notes and self._serialize(notes) or '')
 
 
 @register
@@ -7,10 +7,13 @@ import json
 import re
 import os.path
 import urllib
-from . import register, Site, Section, Chapter, Image
+from . import register, Site, Section, Chapter, Image, selector
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+_namespaced_tag = re.compile(r'[a-z]+:[a-z]+')
+
 """
 Example JSON:
 {
@@ -104,32 +107,33 @@ class Arbitrary(Site):
 
     def _chapter(self, url, definition, title=False):
         logger.info("Extracting chapter @ %s", url)
-        soup = self._soup(url)
+        with metrics.kind('chapter'):
+            soup = self._soup(url)
 
         chapters = []
 
-        if not soup.select(definition.content_selector):
+        if not selector(definition.content_selector).select(soup):
             return chapters
 
         # clean up a few things which will definitely break epubs:
         # TODO: expand this greatly, or make it configurable
-        for namespaced in soup.find_all(re.compile(r'[a-z]+:[a-z]+')):
+        for namespaced in soup.find_all(_namespaced_tag):
             # Namespaced elements are going to cause validation errors
             namespaced.decompose()
 
-        for content in soup.select(definition.content_selector):
+        for content in selector(definition.content_selector).select(soup):
             if definition.filter_selector:
-                for filtered in content.select(definition.filter_selector):
+                for filtered in selector(definition.filter_selector).select(content):
                     filtered.decompose()
 
             if definition.content_title_selector:
-                title_element = content.select(definition.content_title_selector)
+                title_element = selector(definition.content_title_selector).select(content)
                 if title_element:
                     title = title_element[0].get_text().strip()
 
             if definition.content_text_selector:
                 # TODO: multiple text elements?
-                content = content.select(definition.content_text_selector)[0]
+                content = selector(definition.content_text_selector).select(content)[0]
 
             # TODO: consider `'\n'.join(map(str, content.contents))`
             content.name = 'div'
@@ -142,7 +146,7 @@ class Arbitrary(Site):
 
             chapters.append(Chapter(
                 title=title,
-                contents=content.prettify(),
+                contents=self._serialize(content),
                 # TODO: better date detection
                 date=datetime.datetime.now(),
                 images=images
@@ -160,7 +164,7 @@ class Arbitrary(Site):
             url = urllib.parse.urlparse(image_url)
             local_path = 'chapter_images/' + url.path.strip('/')
 
-            image_res = self.session.get(image_url)
+            image_res = self._get(image_url)
             content_type = image_res.headers['Content-Type']
             image_data = image_res.content
 
@@ -0,0 +1,37 @@
+#!/usr/bin/python
+
+import datetime
+import re
+import attr
+
+
+def _timedelta(seconds):
+    if seconds is None or isinstance(seconds, datetime.timedelta):
+        return seconds
+    return datetime.timedelta(seconds=seconds)
+
+
+@attr.s(frozen=True)
+class CachePolicy:
+    """How long responses for URLs matching `pattern` stay fresh.
+
+    `pattern` is a regex searched for anywhere in the URL. An `expire_after`
+    of None means never expire; 0 means always revalidate.
+    """
+    pattern = attr.ib(converter=re.compile)
+    expire_after = attr.ib(converter=_timedelta)
+
+    @classmethod
+    def from_json(cls, data):
+        """Build a list of policies from leech.json, e.g.
+
+            [{"pattern": "/chapter/\\d+", "expire_after": 2592000}]
+
+        An `{pattern: expire_after}` object works too.
+        """
+        if isinstance(data, dict):
+            return [cls(pattern, expire_after) for pattern, expire_after in data.items()]
+        return [cls(policy['pattern'], policy.get('expire_after')) for policy in data]
+
+    def matches(self, url):
+        return bool(self.pattern.search(url))
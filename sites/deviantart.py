@@ -11,6 +11,8 @@ logger = logging.getLogger(__name__)
 
 @register
 class DeviantArt(Stash):
+    hosts = ('deviantart.com',)
+
     @staticmethod
     def matches(url):
         # Need a collection page
@@ -39,11 +41,7 @@ class DeviantArt(Stash):
         thumbs = content.select(".stream a.thumb")
         if not thumbs:
             return
-        for thumb in thumbs:
-            try:
-                if thumb['href'] != '#':
-                    story.add(self._chapter(thumb['href']))
-            except Exception:
-                logger.exception("Couldn't extract chapters from thumbs")
+        for chapter in self._thumb_chapters(thumbs):
+            story.add(chapter)
 
         return story
@@ -5,14 +5,22 @@ import datetime
 import re
 import urllib.parse
 import attr
-from . import register, Site, SiteException, CloudflareException, Section, Chapter
+from . import register, Site, SiteException, CloudflareException, Section, Chapter, CachePolicy
+from .regions import PageRegions
 
 logger = logging.getLogger(__name__)
 
 
 @register
+@attr.s
 class FanFictionNet(Site):
     _cloudflared = attr.ib(init=False, default=False)
+    cache_policies = (
+        CachePolicy(r'/s/\d+/\d+/', 30 * 24 * 3600),
+        CachePolicy(r'/s/\d+/$', 10 * 60),
+    )
+    chapter_regions = PageRegions(ids=('content_wrapper_inner',))
+    hosts = ('fanfiction.net',)
 
     """FFN: it has a lot of stuff"""
     @staticmethod
@@ -60,20 +68,24 @@ class FanFictionNet(Site):
 
             # beautiful soup doesn't handle ffn's unclosed option tags at all well here
             options = re.findall(r'<option.+?value="?(\d+)"?[^>]*>([^<]+)', str(chapter_select))
-            for option in options:
-                story.add(Chapter(title=option[1], contents=self._chapter(base_url + option[0] + suffix), date=False))
+            titles = {base_url + option[0] + suffix: option[1] for option in options}
+
+            def process(chapter_url, chapter_soup):
+                return Chapter(title=titles[chapter_url], contents=self._chapter(chapter_url, chapter_soup), date=False)
+
+            for chapter in self._chapters(list(titles), process):
+                story.add(chapter)
 
             # fix up the dates
             story[-1].date = updated
             story[0].date = published
         else:
-            story.add(Chapter(title=story.title, contents=self._chapter(url), date=published))
+            story.add(Chapter(title=story.title, contents=self._chapter(url, soup), date=published))
 
         return story
 
-    def _chapter(self, url):
-        logger.info("Fetching chapter @ %s", url)
-        soup = self._soup(url)
+    def _chapter(self, url, soup):
+        logger.info("Extracting chapter @ %s", url)
 
         content = soup.find(id="content_wrapper_inner")
         if not content:
@@ -93,13 +105,13 @@ class FanFictionNet(Site):
 
         self._clean(text)
 
-        return text.prettify()
+        return self._serialize(text)
 
     def _soup(self, url, *args, **kwargs):
         if self._cloudflared:
             fallback = f"https://archive.org/wayback/available?url={urllib.parse.quote(url)}"
             try:
-                response = self.session.get(fallback)
+                response = self._get(fallback)
                 wayback = response.json()
                 closest = wayback['archived_snapshots']['closest']['url']
                 return super()._soup(closest, *args, delay=1, **kwargs)
@@ -107,7 +119,7 @@ class FanFictionNet(Site):
                 self.session.cache.delete_url(fallback)
                 raise CloudflareException("Couldn't fetch, presumably because of Cloudflare protection, and falling back to archive.org failed; if some chapters were succeeding, try again?", url, fallback)
         try:
-            super()._soup(self, url, *args, **kwargs)
+            return super()._soup(url, *args, **kwargs)
         except CloudflareException:
             self._cloudflared = True
             return self._soup(url, *args, **kwargs)
@@ -115,6 +127,8 @@ class FanFictionNet(Site):
 
 @register
 class FictionPress(FanFictionNet):
+    hosts = ('fictionpress.com',)
+
     @staticmethod
     def matches(url):
         # e.g. https://www.fictionpress.com/s/2961893/1/Mother-of-Learning
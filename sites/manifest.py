@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+"""What each site module handles, without having to import it.
+
+sites.get only imports the modules whose entry here matches a URL, and the
+CLI's site-specific options come from here, so that starting up doesn't mean
+importing every site (and everything they use). When adding a site, add its
+module here too; a site class registered with hosts its entry doesn't list
+gets a warning.
+"""
+
+import re
+import attr
+from . import SiteSpecificOption
+
+
+@attr.s(frozen=True)
+class SiteModule:
+    name = attr.ib()
+    # the hosts the module's sites handle URLs on, subdomains included; if empty, it's checked for every URL
+    hosts = attr.ib(default=())
+    # searched for in a URL before the module is imported; only URLs it matches can be handled by the module
+    pattern = attr.ib(default=None)
+    # options on top of Site's own
+    options = attr.ib(default=())
+
+    def wants(self, url):
+        return not self.pattern or bool(re.search(self.pattern, url))
+
+
+SKIP_SPOILERS = SiteSpecificOption(
+    'skip_spoilers',
+    '--skip-spoilers/--include-spoilers',
+    default=True,
+    help="If true, do not transcribe any tags that are marked as a spoiler."
+)
+
+XENFORO_OPTIONS = (
+    SiteSpecificOption(
+        'include_index',
+        '--include-index/--no-include-index',
+        default=False,
+        help="If true, the post marked as an index will be included as a chapter."
+    ),
+    SKIP_SPOILERS,
+    SiteSpecificOption(
+        'offset',
+        '--offset',
+        type=int,
+        help="The chapter index to start in the chapter marks."
+    ),
+    SiteSpecificOption(
+        'limit',
+        '--limit',
+        type=int,
+        help="The chapter to end at at in the chapter marks."
+    ),
+)
+
+MODULES = (
+    SiteModule(
+        'ao3',
+        hosts=('archiveofourown.org',),
+        pattern=r'^https?://(?:www\.)?archiveofourown\.org/(?:works|series)/\d+'
+    ),
+    SiteModule('arbitrary', pattern=r'\.json$'),
+    SiteModule(
+        'deviantart',
+        hosts=('deviantart.com',),
+        pattern=r'^https?://[^.]+\.deviantart\.com/(?:gallery|favourites)/\d+'
+    ),
+    SiteModule(
+        'fanfictionnet',
+        hosts=('fanfiction.net', 'fictionpress.com'),
+        pattern=r'^https?://(?:www|m)\.(?:fanfiction\.net|fictionpress\.com)/s/\d+'
+    ),
+    SiteModule(
+        'fictionlive',
+        hosts=('fiction.live',),
+        pattern=r'^https?://fiction\.live/(?:stories|Sci-fi)/'
+    ),
+    SiteModule(
+        'royalroad',
+        hosts=('royalroad.com', 'royalroadl.com'),
+        pattern=r'^https?://(?:www\.)?royalroadl?\.com/fiction/\d+',
+        options=(SKIP_SPOILERS,)
+    ),
+    SiteModule('stash', hosts=('sta.sh',), pattern=r'^https?://sta\.sh/2'),
+    SiteModule('wattpad', hosts=('wattpad.com',), pattern=r'^https?://(?:www\.)?wattpad\.com/story/\d+'),
+    SiteModule(
+        'xenforo',
+        hosts=('forum.questionablequesting.com', 'www.alternatehistory.com'),
+        pattern=r'/(?:threads|posts)/',
+        options=XENFORO_OPTIONS
+    ),
+    SiteModule(
+        'xenforo2',
+        hosts=('forums.spacebattles.com', 'forums.sufficientvelocity.com'),
+        pattern=r'/(?:threads|posts)/',
+        options=XENFORO_OPTIONS
+    ),
+)
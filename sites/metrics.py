@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+import collections
+import contextlib
+import json
+import threading
+import time
+import urllib.parse
+import attr
+
+# What a request was for. Chapters are known as they're fetched; anything else
+# is worked out from what came back.
+KINDS = ('index', 'chapter', 'image', 'api')
+
+# Where the rest of the time goes. Stages can nest (e.g. rendering a chapter
+# includes waiting for its images), and each only counts the time which isn't
+# in a stage inside it. Images are compressed off to the side, several at a
+# time, so image_compress is the CPU time that took, alongside everything
+# else; image_wait is how long rendering was held up waiting for images.
+STAGES = ('fetch', 'parse', 'clean', 'render', 'image_wait', 'image_compress', 'zip_write')
+
+
+@attr.s
+class RequestRecord:
+    url = attr.ib()
+    host = attr.ib()
+    kind = attr.ib()
+    status = attr.ib()
+    bytes = attr.ib()
+    # how long the response took to arrive, not counting time spent waiting to send it
+    seconds = attr.ib()
+    # hit, miss, revalidated, or off if the session doesn't cache
+    cache = attr.ib()
+    # how many times this URL had already failed
+    retries = attr.ib(default=0)
+    # how long the request waited on the rate limiter first
+    slept = attr.ib(default=0)
+    started = attr.ib(factory=time.time)
+
+
+@attr.s
+class Metrics:
+    """Timings for everything a download does, shared by the whole process.
+
+    Every request made through Site._get (and every image download) is
+    recorded, and `stage()` times the CPU-bound work in between. The records
+    can be written out as JSON lines, or summarized.
+    """
+    requests = attr.ib(factory=list, init=False)
+    # stage name -> [count, seconds]
+    stages = attr.ib(factory=lambda: collections.defaultdict(lambda: [0, 0.0]), init=False)
+    _lock = attr.ib(factory=threading.Lock, init=False)
+    _local = attr.ib(factory=threading.local, init=False)
+
+    def record(self, url, response, seconds, kind=None, retries=0, slept=0):
+        if getattr(response, 'revalidated', False):
+            cache = 'revalidated'
+        elif hasattr(response, 'from_cache'):
+            cache = 'hit' if response.from_cache else 'miss'
+        else:
+            cache = 'off'
+        record = RequestRecord(
+            url=url,
+            host=urllib.parse.urlparse(url).netloc,
+            kind=kind or getattr(self._local, 'kind', None) or _kind(response),
+            status=response.status_code,
+            bytes=len(response.content or b''),
+            seconds=seconds,
+            cache=cache,
+            retries=retries,
+            slept=slept,
+        )
+        with self._lock:
+            self.requests.append(record)
+        return record
+
+    @contextlib.contextmanager
+    def kind(self, kind):
+        """Requests made on this thread inside this are for `kind` (e.g. chapter)"""
+        previous = getattr(self._local, 'kind', None)
+        self._local.kind = kind
+        try:
+            yield
+        finally:
+            self._local.kind = previous
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self._local.__dict__.setdefault('stages', [])
+        # [when it started, time spent in stages inside it]
+        frame = [time.perf_counter(), 0.0]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed = time.perf_counter() - frame[0]
+            if stack:
+                stack[-1][1] += elapsed
+            self.add_stage(name, elapsed - frame[1])
+
+    def add_stage(self, name, seconds, count=1):
+        with self._lock:
+            totals = self.stages[name]
+            totals[0] += count
+            totals[1] += seconds
+
+    def drain(self):
+        """Everything recorded so far, as plain data, forgetting it here; see merge"""
+        with self._lock:
+            drained = {
+                'requests': [attr.asdict(record) for record in self.requests],
+                'stages': {name: list(totals) for name, totals in self.stages.items()},
+            }
+            self.requests = []
+            self.stages.clear()
+        return drained
+
+    def merge(self, drained):
+        """Add in what another process drained"""
+        with self._lock:
+            self.requests.extend(RequestRecord(**record) for record in drained['requests'])
+        for name, (count, seconds) in drained['stages'].items():
+            self.add_stage(name, seconds, count)
+
+    def write_jsonl(self, out):
+        with self._lock:
+            for record in self.requests:
+                out.write(json.dumps(dict(type='request', **attr.asdict(record))) + '\n')
+            for name, (count, seconds) in self.stages.items():
+                out.write(json.dumps({'type': 'stage', 'stage': name, 'count': count, 'seconds': seconds}) + '\n')
+
+    def summary(self):
+        """Lines describing where the time went"""
+        with self._lock:
+            requests = list(self.requests)
+            stages = {name: list(totals) for name, totals in self.stages.items()}
+        if not requests and not stages:
+            return []
+        cache = collections.Counter(record.cache for record in requests)
+        lines = [
+            f"{len(requests)} requests ({', '.join(f'{n} {status}' for status, n in cache.most_common())}), "
+            f"{_size(sum(record.bytes for record in requests))}, "
+            f"{sum(record.seconds for record in requests):.1f}s waiting on responses, "
+            f"{sum(record.slept for record in requests):.1f}s rate limited, "
+            f"{sum(1 for record in requests if record.retries)} retries"
+        ]
+        for group, key in (('kind', lambda record: record.kind), ('host', lambda record: record.host)):
+            totals = collections.defaultdict(lambda: [0, 0, 0.0])
+            for record in requests:
+                total = totals[key(record)]
+                total[0] += 1
+                total[1] += record.bytes
+                total[2] += record.seconds
+            for name, (count, size, seconds) in sorted(totals.items(), key=lambda item: -item[1][2]):
+                lines.append(f"  {group} {name:<32}{count:>6} requests{_size(size):>10}{seconds:>9.1f}s")
+        for name in sorted(stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+            count, seconds = stages[name]
+            lines.append(f"  stage {name:<31}{count:>6} times{seconds:>22.1f}s")
+        return lines
+
+
+def _kind(response):
+    content_type = response.headers.get('Content-Type', '')
+    if content_type.startswith('image/'):
+        return 'image'
+    if 'json' in content_type:
+        return 'api'
+    return 'index'
+
+
+def _size(b):
+    for unit in ('B', 'KB', 'MB'):
+        if b < 1024:
+            return f'{b:.0f}{unit}' if unit == 'B' else f'{b:.1f}{unit}'
+        b /= 1024
+    return f'{b:.1f}GB'
+
+
+metrics = Metrics()
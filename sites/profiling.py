@@ -0,0 +1,233 @@
+#!/usr/bin/python
+
+import collections
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import sys
+import threading
+import attr
+
+logger = logging.getLogger(__name__)
+
+# Functions which are usually behind a slow download, always listed in the summary. With more
+# than one CPU, images are compressed in other processes, which cProfile doesn't see; the
+# image_compress stage in the metrics summary still counts their CPU time.
+WATCHED = (
+    ('sites/__init__.py', '_soup', 'Site._soup'),
+    ('bs4/__init__.py', '__init__', 'BeautifulSoup.__init__'),
+    ('bs4/element.py', 'prettify', 'Tag.prettify'),
+    ('ebook/image.py', 'compress_image', 'compress_image'),
+    ('zipfile.py', 'writestr', 'ZipFile.writestr'),
+)
+
+# What a thread is doing, going by the innermost Python function it's in
+NETWORK = {
+    ('socket.py', 'readinto'), ('socket.py', 'create_connection'), ('socket.py', 'getaddrinfo'),
+    ('ssl.py', 'read'), ('ssl.py', 'recv_into'), ('ssl.py', 'do_handshake'), ('ssl.py', 'sendall'),
+    ('connection.py', 'create_connection'),
+}
+RATE_LIMITED = {('__init__.py', 'acquire')}
+WAITING = {
+    ('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'), ('threading.py', 'join'),
+    ('queue.py', 'get'), ('queue.py', 'put'), ('_base.py', 'result'), ('_base.py', 'wait'),
+}
+
+# ...and, for cProfile, the built-in function it's in
+BUILTIN_NETWORK = ('recv_into', 'recv', 'send', 'sendall', 'connect', 'getaddrinfo', 'do_handshake', "'read' of '_ssl")
+BUILTIN_SLEEP = ('time.sleep',)
+BUILTIN_WAITING = ("'acquire' of '_thread", 'select.', 'poll')
+
+CATEGORIES = ('cpu', 'network', 'rate limited', 'waiting on other threads')
+
+# Whether each thread needs a cProfile of its own
+PER_THREAD = sys.version_info < (3, 12)
+
+
+def profiler(mode):
+    return {'cprofile': TracingProfiler, 'sample': SamplingProfiler}[mode]()
+
+
+@attr.s
+class TracingProfiler:
+    """cProfile, on every thread which starts while it's running as well as this one.
+
+    Before 3.12 that takes a profiler per thread. From 3.12 cProfile is built
+    on sys.monitoring, so the one profiler already sees every thread, and
+    another can't be enabled alongside it. It keeps a single call stack
+    for all of them though, so calls made on threads at the same time can
+    be miscounted; the sampling profiler doesn't have that problem.
+
+    Writes pstats data, for e.g. `python -m pstats` or snakeviz.
+    """
+    _profiles = attr.ib(factory=list, init=False)
+
+    def start(self):
+        if PER_THREAD:
+            threading.setprofile(self._start_thread)
+        else:
+            logger.warning("cProfile can miscount calls made on several threads at once from Python 3.12; --profile-mode sample won't")
+        self._start_thread()
+
+    def stop(self):
+        if PER_THREAD:
+            threading.setprofile(None)
+        for profile in self._profiles:
+            profile.disable()
+
+    def _start_thread(self, *args):
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        self._profiles.append(profile)
+        profile.enable()
+
+    def stats(self):
+        return pstats.Stats(*self._profiles)
+
+    def write(self, filename):
+        self.stats().dump_stats(filename)
+
+    def summary(self, top=20):
+        stats = self.stats().stats
+        times = collections.Counter()
+        for (filename, line, name), (calls, _, tottime, cumtime, callers) in stats.items():
+            times[_builtin_category(name) if filename == '~' else 'cpu'] += tottime
+        lines = _categories(times, 's', 2)
+
+        lines.append(f"Top {top} functions by cumulative time:")
+        ranked = sorted(stats.items(), key=lambda item: -item[1][3])
+        for (filename, line, name), (calls, _, tottime, cumtime, _) in ranked[:top]:
+            lines.append(f"  {cumtime:>9.2f}s {tottime:>9.2f}s own {calls:>8} calls  {_label(filename, name)}")
+
+        lines.append("Watched functions:")
+        for path, name, label in WATCHED:
+            found = [value for (filename, line, function), value in stats.items() if function == name and _in(filename, path)]
+            calls = sum(value[0] for value in found)
+            cumtime = sum(value[3] for value in found)
+            lines.append(f"  {cumtime:>9.2f}s {calls:>8} calls  {label}")
+        return lines
+
+
+@attr.s
+class SamplingProfiler:
+    """Looks at what every thread is doing every `interval` seconds.
+
+    Much cheaper than cProfile, as nothing happens on the profiled threads
+    themselves. Writes collapsed stacks (one `frame;frame;frame count` line
+    per stack), as read by flamegraph.pl, speedscope, and the like.
+    """
+    interval = attr.ib(default=0.005)
+    stacks = attr.ib(factory=collections.Counter, init=False)
+    _thread = attr.ib(default=None, init=False)
+    _stopping = attr.ib(factory=threading.Event, init=False)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                thread = names.get(ident, 'thread')
+                self.stacks[(thread,) + tuple(reversed(stack))] += 1
+
+    def write(self, filename):
+        with open(filename, 'w') as out:
+            for (thread, *stack), count in self.stacks.most_common():
+                out.write(';'.join([thread] + [_code_label(code) for code in stack]) + f' {count}\n')
+
+    def summary(self, top=20):
+        total = sum(self.stacks.values())
+        samples = collections.Counter()
+        inclusive = collections.Counter()
+        own = collections.Counter()
+        for (thread, *stack), count in self.stacks.items():
+            category = _category(stack[-1]) if stack else 'waiting on other threads'
+            samples[category] += count
+            for label in set(_code_label(code) for code in stack):
+                inclusive[label] += count
+            if stack and category == 'cpu':
+                own[_code_label(stack[-1])] += count
+        lines = _categories(samples, ' samples', 0)
+
+        # threads which are only waiting would crowd out everything else in inclusive samples
+        lines.append(f"Top {top} functions by samples running their own code (of {total}, every {self.interval * 1000:g}ms):")
+        for label, count in own.most_common(top):
+            lines.append(f"  {count:>8} {inclusive[label]:>8} including calls  {label}")
+
+        lines.append("Watched functions:")
+        for path, name, label in WATCHED:
+            count = sum(
+                count for code_label, count in inclusive.items()
+                if code_label.startswith(path + ':') and code_label.partition(':')[2] in (label, name)
+            )
+            lines.append(f"  {count:>8}  {label}")
+        return lines
+
+
+def _categories(amounts, unit, precision):
+    total = sum(amounts.values()) or 1
+    return ["Time by what it was spent on, across threads:"] + [
+        f"  {category:<26}{amounts[category]:>10.{precision}f}{unit} {100 * amounts[category] / total:>5.1f}%"
+        for category in CATEGORIES
+    ]
+
+
+def _category(code):
+    where = (os.path.basename(code.co_filename), code.co_name)
+    if where in NETWORK:
+        return 'network'
+    if where in RATE_LIMITED and 'sites' in code.co_filename:
+        return 'rate limited'
+    if where in WAITING:
+        return 'waiting on other threads'
+    return 'cpu'
+
+
+def _builtin_category(name):
+    if any(pattern in name for pattern in BUILTIN_NETWORK):
+        return 'network'
+    if any(pattern in name for pattern in BUILTIN_SLEEP):
+        return 'rate limited'
+    if any(pattern in name for pattern in BUILTIN_WAITING):
+        return 'waiting on other threads'
+    return 'cpu'
+
+
+def _in(filename, path):
+    return filename.replace(os.sep, '/').endswith('/' + path)
+
+
+@functools.lru_cache(maxsize=None)
+def _short(filename):
+    # the module's package too, if it's in one: sites/__init__.py rather than just __init__.py
+    directory, name = os.path.split(filename)
+    if os.path.exists(os.path.join(directory, '__init__.py')):
+        return f'{os.path.basename(directory)}/{name}'
+    return name
+
+
+def _label(filename, name):
+    if filename == '~':
+        return name
+    return f'{_short(filename)}:{name}'
+
+
+def _code_label(code):
+    return f'{_short(code.co_filename)}:{getattr(code, "co_qualname", code.co_name)}'
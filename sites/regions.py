@@ -0,0 +1,37 @@
+#!/usr/bin/python
+
+from bs4 import SoupStrainer
+
+
+class PageRegions(SoupStrainer):
+    """The parts of a page which a site needs, so the rest of it needn't be
+    parsed: any element with one of `ids`, or one of `classes`, along with
+    everything inside it. Only whole tags are kept, so a site mustn't look at
+    anything outside of those, including their parents.
+    """
+
+    def __init__(self, ids=(), classes=()):
+        super().__init__()
+        self.ids = frozenset(ids)
+        self.classes = frozenset(classes)
+
+    def wants(self, attrs):
+        if attrs.get('id') in self.ids:
+            return True
+        # while parsing, class is still the attribute's string rather than a list
+        classes = attrs.get('class') or ()
+        if isinstance(classes, str):
+            classes = classes.split()
+        return not self.classes.isdisjoint(classes)
+
+    # BeautifulSoup 4.13 and later
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return self.wants(attrs or {})
+
+    def allow_string_creation(self, string):
+        return False
+
+    # Earlier versions
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        if self.wants(markup_attrs or {}):
+            return markup_name
@@ -3,8 +3,8 @@
 import http.client
 import logging
 import datetime
-import re
-from . import register, Site, Section, Chapter, SiteSpecificOption
+from . import register, Site, Section, Chapter, CachePolicy, domain_pattern, manifest
+from .regions import PageRegions
 
 logger = logging.getLogger(__name__)
 
@@ -12,28 +12,30 @@ logger = logging.getLogger(__name__)
 @register
 class RoyalRoad(Site):
     domain = r'royalroad'
+    cache_policies = (
+        CachePolicy(r'/fiction/\d+/[^/]+/chapter/', 30 * 24 * 3600),
+        CachePolicy(r'/fiction/\d+/?$', 10 * 60),
+    )
+    chapter_regions = PageRegions(classes=('chapter-content', 'author-note-portlet', 'profile-info'))
 
     @staticmethod
     def get_site_specific_option_defs():
-        return Site.get_site_specific_option_defs() + [
-            SiteSpecificOption(
-                'skip_spoilers',
-                '--skip-spoilers/--include-spoilers',
-                default=True,
-                help="If true, do not transcribe any tags that are marked as a spoiler."
-            ),
-        ]
+        return Site.get_site_specific_option_defs() + [manifest.SKIP_SPOILERS]
 
     """Royal Road: a place where people write novels, mostly seeming to be light-novel in tone."""
+    @classmethod
+    def get_hosts(cls):
+        return (f'{cls.domain}.com',)
+
     @classmethod
     def matches(cls, url):
         # e.g. https://royalroad.com/fiction/6752/lament-of-the-fallen
-        match = re.match(r'^(https?://(?:www\.)?%s\.com/fiction/\d+)/?.*' % cls.domain, url)
+        match = domain_pattern(r'^(https?://(?:www\.)?%s\.com/fiction/\d+)/?.*', cls.domain).match(url)
         if match:
             return match.group(1) + '/'
 
     def extract(self, url):
-        workid = re.match(r'^https?://(?:www\.)?%s\.com/fiction/(\d+)/?.*' % self.domain, url).group(1)
+        workid = domain_pattern(r'^https?://(?:www\.)?%s\.com/fiction/(\d+)/?.*', self.domain).match(url).group(1)
         soup = self._soup(f'https://www.{self.domain}.com/fiction/{workid}')
         # should have gotten redirected, for a valid title
 
@@ -51,12 +53,17 @@ class RoyalRoad(Site):
             tags=[tag.get_text().strip() for tag in soup.select('span.tags a.fiction-tag')]
         )
 
+        titles = {}
         for chapter in soup.select('#chapters tbody tr[data-url]'):
             chapter_url = str(self._join_url(story.url, str(chapter.get('data-url'))))
+            titles[chapter_url] = chapter.find('a', href=True).string.strip()
 
-            contents, updated = self._chapter(chapter_url, len(story) + 1)
+        def process(chapter_url, chapter_soup):
+            contents, updated = self._chapter(chapter_url, chapter_soup, len(story) + 1)
+            return Chapter(title=titles[chapter_url], contents=contents, date=updated)
 
-            story.add(Chapter(title=chapter.find('a', href=True).string.strip(), contents=contents, date=updated))
+        for chapter in self._chapters(list(titles), process):
+            story.add(chapter)
 
         http.client._MAXHEADERS = original_maxheaders
 
@@ -65,26 +72,25 @@ class RoyalRoad(Site):
 
         return story
 
-    def _chapter(self, url, chapterid):
+    def _chapter(self, url, soup, chapterid):
         logger.info("Extracting chapter @ %s", url)
-        soup = self._soup(url)
         content = soup.find('div', class_='chapter-content')
 
         self._clean(content)
         self._clean_spoilers(content, chapterid)
 
-        content = content.prettify()
+        content = self._serialize(content)
 
         author_note = soup.find_all('div', class_='author-note-portlet')
 
         if len(author_note) == 1:
-            # Find the parent of chapter-content and check if the author's note is the first child div
-            if 'author-note-portlet' in soup.find('div', class_='chapter-content').parent.find('div')['class']:
-                content = author_note[0].prettify() + '<hr/>' + content
+            # Check whether the author's note comes before chapter-content; only these parts of the page were parsed, so look back rather than up
+            if soup.find('div', class_='chapter-content').find_previous('div', class_='author-note-portlet'):
+                content = self._serialize(author_note[0]) + '<hr/>' + content
             else:  # The author note must be after the chapter content
-                content = content + '<hr/>' + author_note[0].prettify()
+                content = content + '<hr/>' + self._serialize(author_note[0])
         elif len(author_note) == 2:
-            content = author_note[0].prettify() + '<hr/>' + content + '<hr/>' + author_note[1].prettify()
+            content = self._serialize(author_note[0]) + '<hr/>' + content + '<hr/>' + self._serialize(author_note[1])
 
         updated = datetime.datetime.fromtimestamp(
             int(soup.find(class_="profile-info").find('time').get('unixtime'))
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+import datetime
+import itertools
+import logging
+import threading
+import requests
+import requests_cache
+from requests.hooks import dispatch_hook
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Connections kept open to each host: room for a site's concurrency, or for
+# all of ebook's image threads, without opening and dropping extras
+POOL_SIZE = 16
+
+
+def pooled_adapter():
+    """An HTTPAdapter with room for POOL_SIZE connections to each host, which
+    tries again, after a short backoff, when it can't connect or the
+    connection drops.
+
+    Error statuses (429s, 5xxs) are left to whatever made the request, which
+    can wait its turn with the rate limiter first: see Site._soup and
+    ebook.image.fetch_image.
+    """
+    retry = Retry(total=3, connect=3, read=3, status=0, backoff_factor=0.5, respect_retry_after_header=False)
+    return requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+
+class RevalidatingSession(requests_cache.CachedSession):
+    """A CachedSession which doesn't just throw away expired responses.
+
+    If an expired response came with an ETag or Last-Modified header, the
+    server is asked whether it's changed (If-None-Match / If-Modified-Since)
+    before anything is downloaded again. A 304 refreshes the cached copy and
+    returns it with both `from_cache` and `revalidated` set.
+
+    How long a response stays fresh can depend on its URL: the first of
+    `cache_policies` which matches wins, falling back to `expire_after`. A
+    single request can be given extra policies to check first, with
+    `session.get(url, cache_policies=[...])`.
+    """
+
+    def __init__(self, *args, cache_policies=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_policies = list(cache_policies)
+        # policies for the request currently being made on this thread
+        self._request_policies = threading.local()
+        # the last response is_fresh loaded on this thread, so send needn't unpickle it again
+        self._looked_up = threading.local()
+
+    def request(self, method, url, *args, cache_policies=(), **kwargs):
+        previous = getattr(self._request_policies, 'policies', ())
+        self._request_policies.policies = cache_policies
+        try:
+            return super().request(method, url, *args, **kwargs)
+        finally:
+            self._request_policies.policies = previous
+
+    def expire_after_for(self, url, policies=()):
+        for policy in itertools.chain(policies, self.cache_policies):
+            if policy.matches(url):
+                return policy.expire_after
+        return self._cache_expire_after
+
+    def is_fresh(self, url, cache_policies=(), params=None, headers=None, **kwargs):
+        """Whether a GET of `url` would come straight from the cache, without
+        asking the host anything (not even whether it's changed)"""
+        if self._is_cache_disabled or 'GET' not in self._cache_allowable_methods:
+            return False
+        request = self.prepare_request(requests.Request('GET', url, params=params, headers=headers))
+        cache_key = self.cache.create_key(request)
+        cached, timestamp = self._cached(cache_key)
+        self._looked_up.entry = (cache_key, cached, timestamp)
+        return cached is not None and not self._is_expired(request, timestamp, cache_policies)
+
+    def send(self, request, **kwargs):
+        if self._is_cache_disabled or request.method not in self._cache_allowable_methods:
+            return super().send(request, **kwargs)
+
+        cache_key = self.cache.create_key(request)
+        cached, timestamp = self._cached(cache_key)
+        if cached is None:
+            return self._fetch(request, cache_key, **kwargs)
+        if not self._is_expired(request, timestamp):
+            cached.from_cache = True
+            return dispatch_hook('response', request.hooks, cached, **kwargs)
+
+        validators = {}
+        if cached.headers.get('ETag'):
+            validators['If-None-Match'] = cached.headers['ETag']
+        if cached.headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = cached.headers['Last-Modified']
+        if not validators:
+            # nothing to revalidate with, so it's a plain refetch
+            return self._fetch(request, cache_key, **kwargs)
+
+        conditional = request.copy()
+        conditional.headers.update(validators)
+        response = requests.Session.send(self, conditional, **kwargs)
+        if response.status_code == 304:
+            logger.debug("Revalidated %s", request.url)
+            response.close()
+            # re-saving it resets the cache timestamp
+            self.cache.save_response(cache_key, cached)
+            cached.from_cache = True
+            cached.revalidated = True
+            return dispatch_hook('response', request.hooks, cached, **kwargs)
+        return self._store(cache_key, response)
+
+    def _cached(self, cache_key):
+        """The cached response for `cache_key` and when it was saved, if any;
+        taken from is_fresh, if that's just loaded it on this thread"""
+        entry = getattr(self._looked_up, 'entry', None)
+        self._looked_up.entry = None
+        if entry and entry[0] == cache_key:
+            return entry[1:]
+        try:
+            return self.cache.get_response_and_time(cache_key)
+        except (ImportError, TypeError):
+            return None, None
+
+    def _fetch(self, request, cache_key, **kwargs):
+        return self._store(cache_key, requests.Session.send(self, request, **kwargs))
+
+    def _store(self, cache_key, response):
+        response.from_cache = False
+        if response.status_code in self._cache_allowable_codes:
+            self.cache.save_response(cache_key, response)
+        return response
+
+    def _is_expired(self, request, timestamp, policies=None):
+        if policies is None:
+            policies = getattr(self._request_policies, 'policies', ())
+        expire_after = self.expire_after_for(request.url, policies)
+        return expire_after is not None and datetime.datetime.utcnow() - timestamp > expire_after
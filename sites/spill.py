@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+import tempfile
+import threading
+import attr
+
+
+@attr.s(slots=True, frozen=True)
+class Spilled:
+    """Stands in for a str or bytes which was written out to the spill file"""
+    spill = attr.ib(repr=False)
+    offset = attr.ib()
+    length = attr.ib()
+    # whether it was a str, rather than bytes
+    text = attr.ib()
+
+    def load(self):
+        data = self.spill.read(self.offset, self.length)
+        return data.decode('utf8') if self.text else data
+
+    def __reduce__(self):
+        # the spill file is this process's own, so what goes elsewhere is the value itself
+        return (str if self.text else bytes, (self.load(),))
+
+
+@attr.s
+class Spill:
+    """Keeps chapter contents and image data in a temporary file rather than in memory.
+
+    Off unless there's a threshold. Once there is, Chapter and Image contents
+    at least that long (in characters for text, bytes otherwise) are written
+    out as they're set, and only where they went is kept; they're read back
+    in whenever they're used. That way a story with thousands of chapters
+    only holds their titles and dates in memory. Nothing is ever removed from
+    the file, which goes when the process ends.
+    """
+    threshold = attr.ib(default=None)
+    # where the file goes, if not the usual temporary directory
+    directory = attr.ib(default=None)
+    _file = attr.ib(default=None, init=False)
+    _end = attr.ib(default=0, init=False)
+    _lock = attr.ib(factory=threading.Lock, init=False)
+
+    def configure(self, threshold, directory=None):
+        self.threshold = threshold
+        self.directory = directory
+
+    def store(self, value):
+        """`value`, or a Spilled in its place if it's long enough to go out to the file"""
+        if not self.threshold or not isinstance(value, (str, bytes)) or len(value) < self.threshold:
+            return value
+        text = isinstance(value, str)
+        data = value.encode('utf8') if text else value
+        with self._lock:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile(prefix='leech-spill-', dir=self.directory)
+            offset = self._end
+            self._file.seek(offset)
+            self._file.write(data)
+            self._end += len(data)
+        return Spilled(self, offset, len(data), text)
+
+    def load(self, value):
+        """The other way around from store: `value` itself, or what it stands in for"""
+        return value.load() if isinstance(value, Spilled) else value
+
+    def close(self):
+        """Drops the file, and everything in it"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._end = 0
+
+    def read(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    @property
+    def size(self):
+        """How much has been written out so far"""
+        return self._end
+
+
+spill = Spill()
@@ -10,6 +10,8 @@ logger = logging.getLogger(__name__)
 
 @register
 class Stash(Site):
+    hosts = ('sta.sh',)
+
     @staticmethod
     def matches(url):
         # Need a stack page
@@ -33,18 +35,31 @@ class Stash(Site):
         thumbs = content.select(".stash-folder-stream .thumb")
         if not thumbs:
             return
-        for thumb in thumbs:
+        for chapter in self._thumb_chapters(thumbs):
+            story.add(chapter)
+
+        return story
+
+    def _thumb_chapters(self, thumbs):
+        def fetch(url):
             try:
-                if thumb['href'] != '#':
-                    story.add(self._chapter(thumb['href']))
+                return self._soup(url)
             except Exception:
                 logger.exception("Couldn't extract chapters from thumbs")
 
-        return story
+        def process(url, soup):
+            if not soup:
+                return
+            try:
+                return self._chapter(url, soup)
+            except Exception:
+                logger.exception("Couldn't extract chapters from thumbs")
 
-    def _chapter(self, url):
-        logger.info("Fetching chapter @ %s", url)
-        soup = self._soup(url)
+        urls = [thumb['href'] for thumb in thumbs if thumb.get('href', '#') != '#']
+        return self._chapters(urls, process, fetch=fetch)
+
+    def _chapter(self, url, soup):
+        logger.info("Extracting chapter @ %s", url)
 
         content = soup.find(class_="journal-wrapper")
         if not content:
@@ -58,13 +73,13 @@ class Stash(Site):
         # TODO: be more selective about this somehow
         try:
             for tag in text.find_all(True):
-                tag.attrs = None
+                tag.attrs.clear()
         except Exception as e:
             raise SiteException("Trouble cleaning attributes", e)
 
         self._clean(text)
 
-        return Chapter(title=title, contents=text.prettify(), date=self._date(soup))
+        return Chapter(title=title, contents=self._serialize(text), date=self._date(soup))
 
     def _date(self, soup):
         maybe_date = soup.find('div', class_="dev-metainfo-details").find('span', ts=True)
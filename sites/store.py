@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+import collections
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+import zlib
+import attr
+from . import Chapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FILENAME = 'leech_chapters.sqlite'
+IMAGE_CACHE_FILENAME = 'leech_images.sqlite'
+
+StoredChapter = collections.namedtuple('StoredChapter', 'chapter, chapterid, footnote_start, footnotes, stored')
+
+
+@attr.s
+class ChapterStore:
+    """Keeps processed chapters on disk, so rebuilding an ebook doesn't need to
+    fetch and clean them all over again.
+
+    Chapters are keyed by site, story and chapter URL, plus the options which
+    affect their contents (e.g. strip_colors), and stored zlib-compressed along
+    with a hash of them and when they were stored. They're kept until flushed,
+    or, given a `max_age`, until they're that old, after which they aren't
+    loaded and their pages are fetched again; one saved again unchanged
+    (going by the hash) just has its time brought up to date. How long the
+    HTTP cache keeps pages doesn't come into it, so a rebuild needn't go back
+    to the site for its chapters. A connection is opened per operation, so a
+    store can be shared between threads or handed to other processes.
+    """
+    filename = attr.ib(default=DEFAULT_FILENAME)
+    # a datetime.timedelta, or None to keep chapters until flushed
+    max_age = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        with self._connection() as conn:
+            conn.execute("""
+                create table if not exists chapters (
+                    site text, story text, url text, options text,
+                    hash text, chapterid integer, footnote_start integer,
+                    data blob, stored timestamp,
+                    primary key (site, story, url, options)
+                )
+            """)
+
+    def story(self, site, story):
+        return StoredStory(self, site, story)
+
+    def load(self, site, story, urls, options):
+        chapters = {}
+        expired = 0
+        now = datetime.datetime.now()
+        with self._connection() as conn:
+            for url in urls:
+                row = conn.execute(
+                    "select chapterid, footnote_start, data, stored from chapters where site=? and story=? and url=? and options=?",
+                    (site, story, url, options)
+                ).fetchone()
+                if row and self.max_age is not None and now - datetime.datetime.fromisoformat(row[3]) > self.max_age:
+                    expired += 1
+                elif row:
+                    title, date, contents, images, footnotes = pickle.loads(zlib.decompress(row[2]))
+                    chapters[url] = StoredChapter(
+                        chapter=Chapter(title=title, contents=contents, date=date, images=images),
+                        chapterid=row[0],
+                        footnote_start=row[1],
+                        footnotes=footnotes,
+                        stored=datetime.datetime.fromisoformat(row[3])
+                    )
+        if expired:
+            logger.info("Fetching %d stored chapters again, as they're older than %s", expired, self.max_age)
+        if chapters:
+            logger.info("Reusing %d stored chapters", len(chapters))
+        return chapters
+
+    def save(self, site, story, url, options, chapter, chapterid, footnote_start, footnotes):
+        pickled = pickle.dumps((chapter.title, chapter.date, chapter.contents, chapter.images, footnotes))
+        digest = hashlib.sha256(pickled).hexdigest()
+        now = datetime.datetime.now()
+        with self._connection() as conn:
+            unchanged = conn.execute(
+                "update chapters set chapterid=?, footnote_start=?, stored=? where site=? and story=? and url=? and options=? and hash=?",
+                (chapterid, footnote_start, now, site, story, url, options, digest)
+            ).rowcount
+            if unchanged:
+                logger.debug("Stored chapter is unchanged: %s", url)
+                return
+            conn.execute(
+                "insert or replace into chapters values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (site, story, url, options, digest, chapterid, footnote_start, zlib.compress(pickled), now)
+            )
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("delete from chapters")
+        with self._connection() as conn:
+            conn.execute("VACUUM")
+
+    def _connection(self):
+        return _connection(self.filename)
+
+
+@attr.s
+class StoredStory:
+    """A ChapterStore, narrowed down to the chapters of a single story."""
+    store = attr.ib()
+    site = attr.ib()
+    story = attr.ib()
+
+    def load(self, urls, options):
+        return self.store.load(self.site, self.story, urls, self._options(options))
+
+    def save(self, url, options, chapter, chapterid, footnote_start, footnotes):
+        self.store.save(self.site, self.story, url, self._options(options), chapter, chapterid, footnote_start, footnotes)
+
+    @staticmethod
+    def _options(options):
+        return json.dumps(options, sort_keys=True, default=str)
+
+
+@attr.s
+class ImageCache:
+    """Keeps compressed chapter images on disk, so they needn't be downloaded
+    and compressed again for the next ebook which has them.
+
+    Images are keyed by a hash of what was downloaded, so an image which is
+    at several URLs is only kept once, and each URL is remembered along with
+    the hash of what was there. An image compressed differently (e.g. a GIF
+    cut down to its first frame) is kept as a `variant` of it. As with
+    ChapterStore, a connection is opened per operation.
+    """
+    filename = attr.ib(default=IMAGE_CACHE_FILENAME)
+
+    def __attrs_post_init__(self):
+        with self._connection() as conn:
+            conn.execute("create table if not exists sources (url text primary key, hash text)")
+            conn.execute("""
+                create table if not exists images (
+                    hash text primary key, data blob, format text, mime text, stored timestamp
+                )
+            """)
+
+    def digest(self, url):
+        """The hash of the image last downloaded from `url`, if it's here"""
+        with self._connection() as conn:
+            row = conn.execute(
+                "select hash from sources join images using (hash) where url=?", (url,)
+            ).fetchone()
+        return row and row[0]
+
+    def load(self, digest, variant=''):
+        """The compressed image, its format and its mime type, as ebook.image.convert_image returned them"""
+        with self._connection() as conn:
+            row = conn.execute("select data, format, mime from images where hash=?", (digest + variant,)).fetchone()
+        return row and (bytes(row[0]), row[1], row[2])
+
+    def save(self, url, digest, data, image_format, mime, variant=''):
+        with self._connection() as conn:
+            conn.execute(
+                "insert or replace into images values (?, ?, ?, ?, ?)",
+                (digest + variant, data, image_format, mime, datetime.datetime.now())
+            )
+            if url:
+                conn.execute("insert or replace into sources values (?, ?)", (url, digest))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("delete from sources")
+            conn.execute("delete from images")
+        with self._connection() as conn:
+            conn.execute("VACUUM")
+
+    def _connection(self):
+        return _connection(self.filename)
+
+
+@contextlib.contextmanager
+def _connection(filename):
+    conn = sqlite3.connect(filename, timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
@@ -3,7 +3,7 @@
 import logging
 import datetime
 import re
-from . import register, Site, Section, Chapter
+from . import register, Site, Section, Chapter, CachePolicy
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +11,12 @@ logger = logging.getLogger(__name__)
 @register
 class Wattpad(Site):
     """Wattpad"""
+    cache_policies = (
+        CachePolicy(r'/apiv2/storytext\?', 30 * 24 * 3600),
+        CachePolicy(r'/api/v3/stories/', 10 * 60),
+    )
+    hosts = ('wattpad.com',)
+
     @classmethod
     def matches(cls, url):
         # e.g. https://www.wattpad.com/story/208753031-summoned-to-have-tea-with-the-demon-lord-i-guess
@@ -22,7 +28,7 @@ class Wattpad(Site):
 
     def extract(self, url):
         workid = re.match(r'^https?://(?:www\.)?wattpad\.com/story/(\d+)?.*', url).group(1)
-        info = self.session.get(f"https://www.wattpad.com/api/v3/stories/{workid}").json()
+        info = self._get(f"https://www.wattpad.com/api/v3/stories/{workid}").json()
 
         story = Section(
             title=info['title'],
@@ -31,17 +37,22 @@ class Wattpad(Site):
             cover_url=info['cover']
         )
 
-        for chapter in info['parts']:
-            story.add(Chapter(
+        parts = {f"https://www.wattpad.com/apiv2/storytext?id={chapter['id']}": chapter for chapter in info['parts']}
+
+        def process(chapter_url, text):
+            chapter = parts[chapter_url]
+            return Chapter(
                 title=chapter['title'],
-                contents=self._chapter(chapter['id']),
+                contents=self._chapter(chapter['id'], text),
                 # "2020-05-03T22:14:29Z"
                 date=datetime.datetime.fromisoformat(chapter['createDate'].rstrip('Z'))  # modifyDate also?
-            ))
+            )
+
+        for chapter in self._chapters(list(parts), process, fetch=lambda chapter_url: self._get(chapter_url).text):
+            story.add(chapter)
 
         return story
 
-    def _chapter(self, chapterid):
+    def _chapter(self, chapterid, text):
         logger.info(f"Extracting chapter @ {chapterid}")
-        api = self.session.get(f"https://www.wattpad.com/apiv2/storytext?id={chapterid}")
-        return '<div>' + api.text + '</div>'
+        return '<div>' + text + '</div>'
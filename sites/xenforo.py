@@ -5,51 +5,38 @@ import re
 import logging
 from bs4 import BeautifulSoup
 
-from . import register, Site, SiteException, SiteSpecificOption, Section, Chapter
+from . import register, Site, SiteException, Section, Chapter, CachePolicy, domain_pattern, selector, manifest
 
 logger = logging.getLogger(__name__)
 
+_post_id = re.compile(r'posts/(\d+)/?')
+_post_anchor = re.compile(r'.+#post-(\d+)$')
+
 
 class XenForo(Site):
     """XenForo is forum software that powers a number of fiction-related forums."""
 
     domain = False
+    cache_policies = (
+        CachePolicy(r'/posts/\d+/?$', 30 * 24 * 3600),
+        CachePolicy(r'/(?:threadmarks|reader)', 10 * 60),
+    )
 
     @staticmethod
     def get_site_specific_option_defs():
-        return Site.get_site_specific_option_defs() + [
-            SiteSpecificOption(
-                'include_index',
-                '--include-index/--no-include-index',
-                default=False,
-                help="If true, the post marked as an index will be included as a chapter."
-            ),
-            SiteSpecificOption(
-                'skip_spoilers',
-                '--skip-spoilers/--include-spoilers',
-                default=True,
-                help="If true, do not transcribe any tags that are marked as a spoiler."
-            ),
-            SiteSpecificOption(
-                'offset',
-                '--offset',
-                type=int,
-                help="The chapter index to start in the chapter marks."
-            ),
-            SiteSpecificOption(
-                'limit',
-                '--limit',
-                type=int,
-                help="The chapter to end at at in the chapter marks."
-            ),
-        ]
+        return Site.get_site_specific_option_defs() + list(manifest.XENFORO_OPTIONS)
+
+    @classmethod
+    def get_hosts(cls):
+        # the domain can include a path, e.g. www.alternatehistory.com/forum
+        return (cls.domain.split('/')[0],) if cls.domain else ()
 
     @classmethod
     def matches(cls, url):
-        match = re.match(r'^(https?://%s/threads/[^/]*\d+/(?:\d+/)?reader)/?.*' % cls.domain, url)
+        match = domain_pattern(r'^(https?://%s/threads/[^/]*\d+/(?:\d+/)?reader)/?.*', cls.domain).match(url)
         if match:
             return match.group(1)
-        match = re.match(r'^(https?://%s/threads/[^/]*\d+)/?.*' % cls.domain, url)
+        match = domain_pattern(r'^(https?://%s/threads/[^/]*\d+)/?.*', cls.domain).match(url)
         if match:
             return match.group(1) + '/'
 
@@ -105,6 +92,9 @@ class XenForo(Site):
                     if self.options['limit'] and idx >= self.options['limit']:
                         continue
                     title = self._threadmark_title(post)
+                    if len(story) < self.skip_chapters:
+                        story.add(Chapter(title=title, contents=None, date=self._post_date(post)))
+                        continue
                     logger.info("Extracting chapter \"%s\"", title)
 
                     story.add(Chapter(
@@ -124,13 +114,17 @@ class XenForo(Site):
                 if '/members' not in mark.get('href') and '/threadmarks' not in mark.get('href')
             ]
             marks = marks[self.options['offset']:self.options['limit']]
+            # index posts can link to the same post more than once, so go by position rather than href
+            titles = iter([str(mark.string).strip() for mark in marks])
 
-            for idx, mark in enumerate(marks, 1):
-                href = self._join_url(base, mark.get('href'))
-                title = str(mark.string).strip()
-                logger.info("Fetching chapter \"%s\" @ %s", title, href)
-                contents, post_date = self._chapter(href, idx)
-                chapter = Chapter(title=title, contents=contents, date=post_date)
+            def process(href, post):
+                title = next(titles)
+                logger.info("Extracting chapter \"%s\" @ %s", title, href)
+                contents, post_date = self._chapter(post, len(story) + 1)
+                return Chapter(title=title, contents=contents, date=post_date)
+
+            hrefs = [self._join_url(base, mark.get('href')) for mark in marks]
+            for chapter in self._chapters(hrefs, process, fetch=self._post_from_url):
                 story.add(chapter)
 
         story.footnotes = self.footnotes
@@ -159,7 +153,7 @@ class XenForo(Site):
 
     def _threadmark_title(self, post):
         # Get the title, removing "<strong>Threadmark:</strong>" which precedes it
-        return ''.join(post.select('div.threadmarker > span.label')[0].findAll(text=True, recursive=False)).strip()
+        return ''.join(selector('div.threadmarker > span.label').select(post)[0].findAll(text=True, recursive=False)).strip()
 
     def _chapter_list(self, url):
         try:
@@ -191,7 +185,9 @@ class XenForo(Site):
             # Note: the fetched threadmarks can contain more placeholder elements to fetch. Ergo, loop.
             # Good test case: https://forums.sufficientvelocity.com/threads/ignition-mtg-multicross-planeswalker-pc.26099/threadmarks
             # e.g.: <li class="primaryContent threadmarkListItem ThreadmarkFetcher _depth0 filler" data-range-min="0" data-range-max="306" data-thread-id="26099" data-category-id="1" title="305 hidden">
-            response = self.session.post(f'https://{self.domain}/index.php?threads/threadmarks/load-range', data={
+            load_range_url = f'https://{self.domain}/index.php?threads/threadmarks/load-range'
+            self._throttle(load_range_url)
+            response = self.session.post(load_range_url, data={
                 # I did try a fetch on min/data-min+data-max, but there seems
                 # to be an absolute limit which the API fetch won't override
                 'min': fetcher.get('data-range-min'),
@@ -200,7 +196,7 @@ class XenForo(Site):
                 'category_id': fetcher.get('data-category-id'),
                 '_xfResponseType': 'json',
             }).json()
-            responseSoup = BeautifulSoup(response['templateHtml'], 'html5lib')
+            responseSoup = BeautifulSoup(response['templateHtml'], self._parser())
             fetcher.replace_with(responseSoup)
             fetcher = soup.find(class_='ThreadmarkFetcher')
 
@@ -226,24 +222,22 @@ class XenForo(Site):
 
         return links
 
-    def _chapter(self, url, chapterid):
-        post = self._post_from_url(url)
-
+    def _chapter(self, post, chapterid):
         return self._clean_chapter(post, chapterid), self._post_date(post)
 
     def _post_from_url(self, url):
         # URLs refer to specific posts, so get just that one
         # if no specific post referred to, get the first one
-        match = re.search(r'posts/(\d+)/?', url)
+        match = _post_id.search(url)
         if not match:
-            match = re.match(r'.+#post-(\d+)$', url)
+            match = _post_anchor.match(url)
             # could still be nothing here
         postid = match and match.group(1)
         if postid:
             # create a proper post-url, because threadmarks can sometimes
             # mess up page-wise with anchors
             url = 'https://%s/posts/%s/' % (self.domain, postid)
-        soup = self._soup(url, 'html5lib')
+        soup = self._soup(url)
 
         if postid:
             return self._posts_from_page(soup, postid)
@@ -275,11 +269,11 @@ class XenForo(Site):
                 if "margin-left" in tag['style']:
                     continue
                 del tag['style']
-        for tag in post.select('.quoteExpand, .bbCodeBlock-expandLink, .bbCodeBlock-shrinkLink'):
+        for tag in selector('.quoteExpand, .bbCodeBlock-expandLink, .bbCodeBlock-shrinkLink').select(post):
             tag.decompose()
         self._clean(post)
         self._clean_spoilers(post, chapterid)
-        return post.prettify()
+        return self._serialize(post)
 
     def _clean_spoilers(self, post, chapterid):
         # spoilers don't work well, so turn them into epub footnotes
@@ -311,7 +305,7 @@ class XenForo(Site):
 class XenForoIndex(XenForo):
     @classmethod
     def matches(cls, url):
-        match = re.match(r'^(https?://%s/posts/\d+)/?.*' % cls.domain, url)
+        match = domain_pattern(r'^(https?://%s/posts/\d+)/?.*', cls.domain).match(url)
         if match:
             return match.group(1) + '/'
 
@@ -0,0 +1,58 @@
+import base64
+import io
+import unittest
+
+from PIL import Image as PILImage
+
+import ebook
+from sites import Chapter
+
+
+def _png_uri(size, color):
+    out = io.BytesIO()
+    PILImage.new('RGB', size, color).save(out, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(out.getvalue()).decode('ascii')
+
+
+class ImagePipelineProcessesTest(unittest.TestCase):
+    """Forces the process pool, which a single-CPU machine would never use"""
+
+    def test_compresses_in_child_processes(self):
+        sources = [_png_uri((800, 600), color) for color in ('red', 'green', 'blue')]
+        with ebook.ImagePipeline(processes=2) as images:
+            self.assertEqual(images.processes, 2)
+            images.prefetch(sources)
+            placed = [images.image(src, f'images/{index}') for index, src in enumerate(sources)]
+
+        for image in placed:
+            self.assertTrue(image.path.endswith('.jpeg'), image.path)
+            self.assertEqual(PILImage.open(io.BytesIO(image.contents)).format, 'JPEG')
+
+        pool = ebook._process_pools[2]
+        self.assertTrue(pool._processes)
+        self.assertNotEqual(pool._mp_context.get_start_method(), 'fork')
+
+    def test_pipelines_share_a_pool(self):
+        pools = []
+        for color in ('white', 'black'):
+            with ebook.ImagePipeline(processes=2) as images:
+                images.image(_png_uri((400, 300), color), 'images/1')
+            pools.append(ebook._process_pools[2])
+        self.assertIs(pools[0], pools[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class RenderChapterTest(unittest.TestCase):
+    def test_uppercase_img_tags(self):
+        src = _png_uri((40, 30), 'red')
+        chapter = Chapter(title='One', contents=f'<p>Before</p><IMG SRC="{src}" ALT="Red"/><p>After</p>')
+        self.assertIsNotNone(ebook._rewrite_images(chapter.contents, 1))
+
+        downloaded, contents = ebook._render_chapter(chapter, 1)
+        self.assertEqual(len(downloaded), 1)
+        self.assertEqual(
+            contents, f'<p>Before</p><img src="../{downloaded[0].path}" alt="Red" class="img_center"/><p>After</p>'
+        )
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import ebook
+import leech
+import sites
+from ebook.epub import EpubFile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+import fixtures  # noqa: E402
+from offline import FixtureAdapter  # noqa: E402
+
+try:
+    import lxml  # noqa: F401
+except ImportError:
+    lxml = None
+
+
+def _chapters(name, parser):
+    fixture = fixtures.SITES[name](3, 5, 2)
+    session = leech.create_session(False)
+    adapter = FixtureAdapter(fixture.pages)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    with tempfile.TemporaryDirectory() as directory:
+        url = fixture.url
+        if fixture.definition:
+            url = os.path.join(directory, 'definition.json')
+            with open(url, 'w') as definition_file:
+                json.dump(fixture.definition, definition_file)
+        site, url = sites.get(url)
+        options = site.get_default_options()
+        options['parser'] = parser
+        story = site(session, options=options).extract(url)
+    return [(chapter.title, chapter.contents) for chapter in story]
+
+
+NOTES = [
+    '<div epub:type="rearnote" id="footnote1"><a href="chapter1.html#noteback1">^</a><p>The <em>first</em> note.</p></div>',
+    '<div epub:type="rearnote" id="footnote2"><a href="chapter3.html#noteback2">^</a><p>The second.</p></div>',
+]
+
+
+@unittest.skipUnless(lxml, "lxml isn't installed")
+class ParsersTest(unittest.TestCase):
+    """lxml is only worth offering if every site comes out of it the same as from html5lib"""
+
+    def test_sites_extract_the_same_chapters(self):
+        for name in fixtures.SITES:
+            with self.subTest(site=name):
+                self.assertEqual(_chapters(name, 'html5lib'), _chapters(name, 'lxml'))
+
+    def test_existing_footnotes(self):
+        existing = ebook.ExistingEpub(filename='story.epub', meta={}, files=[
+            EpubFile(path='1/footnotes.html', contents=ebook.html_template.format(
+                title="Footnotes", head='', text='\n\n'.join(NOTES)).encode('utf8')),
+        ])
+        for parser in ('html5lib', 'lxml'):
+            with self.subTest(parser=parser):
+                self.assertEqual(existing.footnotes(parser), NOTES)